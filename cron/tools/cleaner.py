@@ -5,11 +5,23 @@ import shutil
 MEDIA_ADDR = '/root/web/media/'
 DAYS_BUFFER = 7
 DAYS_CHECKED = 3
+FAILED_SUFFIX = '.failed' # render failure markers, see viewer.plotter
 
 def main():
     today = datetime.date.today()
     for i in range(DAYS_CHECKED):
         check_and_delete(today - datetime.timedelta(days=DAYS_BUFFER+i+1))
+    delete_failed_markers()
+
+def delete_failed_markers():
+    """Failed renders are retried once their marker is gone."""
+    for folder in os.listdir(MEDIA_ADDR):
+        directory = MEDIA_ADDR + folder
+        if not os.path.isdir(directory):
+            continue
+        for filename in os.listdir(directory):
+            if filename.endswith(FAILED_SUFFIX):
+                os.remove(os.path.join(directory, filename))
 
 def check_and_delete(date):
     for hour in (0, 12):
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from daterange_filter.filter import DateRangeFilter
-from .models import AnnualStat, DailyStat
+from .models import AnnualStat, DailyStat, MonthlyStat
 
 class PercipFilter(admin.SimpleListFilter):
 
@@ -24,3 +24,7 @@ class AnnualStatAdmin(admin.ModelAdmin):
 @admin.register(DailyStat)
 class DailyStatAdmin(admin.ModelAdmin):
     list_filter = ('name', ('date', DateRangeFilter))
+
+@admin.register(MonthlyStat)
+class MonthlyStatAdmin(admin.ModelAdmin):
+    list_filter = ('year', 'month', 'name')
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class PrecipstatConfig(AppConfig):
     name = 'precipstat'
+
+    def ready(self):
+        # Registers the DailyStat receivers that keep the totals in step
+        from precipstat import psche
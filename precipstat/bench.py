@@ -0,0 +1,46 @@
+"""Time SYNOP decoding with ogimet pages, the committed test pages by default.
+
+Usage: python -m precipstat.bench [page.html ...] [rounds]
+"""
+import os
+import re
+import sys
+import time
+
+from .synop import find_reports
+
+PRE_BLOCK = re.compile('<b><pre>([^<>]*)</pre></b>')
+LEGACY = '333.*7([0-9]{4}).*='
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+
+def legacy(blocks):
+    values = []
+    for block in blocks:
+        match = re.search(LEGACY, block.replace('\n', ''))
+        values.append(int(match.group(1)) / 10 if match else None)
+    return values
+
+def decoder(blocks):
+    return [synop.precip24 for block in blocks for synop in find_reports(block)]
+
+def main(pages, rounds=100):
+    blocks = []
+    for page in pages:
+        blocks.extend(PRE_BLOCK.findall(open(page, encoding='utf8').read())[1:])
+    reports = len(decoder(blocks))
+    for label, func in (('legacy', legacy), ('decoder', decoder)):
+        tic = time.time()
+        for i in range(rounds):
+            func(blocks)
+        total = time.time() - tic
+        print('{:>8}: {} reports, {:.3f} ms/round, {:.0f} reports/s'.format(label, reports,
+            total / rounds * 1e3, reports * rounds / total))
+    mismatches = [(old, new) for old, new in zip(legacy(blocks), decoder(blocks)) if old != new]
+    print('{} reports decoded differently from the legacy pattern'.format(len(mismatches)))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    rounds = [int(args.pop())] if args and args[-1].isdigit() else []
+    main(args or [os.path.join(TESTDATA, 'ogimet_59287.html')], *rounds)
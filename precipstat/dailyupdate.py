@@ -13,12 +13,12 @@ os.environ['DJANGO_SETTINGS_MODULE'] = 'windygram.settings'
 
 django.setup()
 
-from django.db.models import Max, Sum
+from django.db.models import F
 
 from precipstat.bot import RichTable, RichText, TybbsBot
 from precipstat.dailyplot import DailyPlot
-from precipstat.models import AnnualStat, DailyStat
-from precipstat.psche import search_missing_list, update_today
+from precipstat.models import AnnualStat, DailyStat, MonthlyStat
+from precipstat.psche import ensure_monthly, search_missing_list, update_today
 from precipstat.pstat import get_month_percent
 
 
@@ -58,15 +58,18 @@ class DailyUpdate:
         self.today = _date
 
     def get_record(self):
-        current_year_records = DailyStat.objects.filter(date__year=self.today.year,
-            date__lt=self.today)
-        qs_record = current_year_records.values('name').annotate(max=Max('percip'))
+        # Past months come from the rollup, the current month from its daily values
+        ensure_monthly(self.today.year)
         self.record_data = {}
-        for query in qs_record:
-            name = query['name']
-            record = query['max']
-            date = current_year_records.filter(name=name, percip=record).latest().date
-            self.record_data[name] = {'date': date, 'record': record}
+        month_start = self.today.replace(day=1)
+        past_months = MonthlyStat.objects.filter(year=self.today.year, month__lt=self.today.month,
+            max_date__isnull=False).values_list('name', 'max_percip', 'max_date')
+        this_month = DailyStat.objects.filter(date__gte=month_start, date__lt=self.today) \
+            .values_list('name', 'percip', 'date')
+        for name, record, day in list(past_months) + list(this_month):
+            prev = self.record_data.get(name)
+            if prev is None or (record, day) > (prev['record'], prev['date']):
+                self.record_data[name] = {'date': day, 'record': record}
 
     def update_data(self):
         self.get_record()
@@ -76,9 +79,10 @@ class DailyUpdate:
         logger.info("End daily update! Now: {}".format(datetime.now()))
 
     def prepare_data(self):
+        ensure_monthly(self.today.year)
         self.today_data = DailyStat.objects.filter(date=self.today).order_by('-percip')
-        self.month_data = DailyStat.objects.filter(date__month=self.today.month,
-            date__year=self.today.year).values('name').annotate(sum=Sum('percip')).order_by('-sum')
+        self.month_data = MonthlyStat.objects.filter(year=self.today.year,
+            month=self.today.month).order_by('-percip').values('name', sum=F('percip'))
         self.annual_data = AnnualStat.objects.filter(year=self.today.year).order_by('-percip')
 
     def prepare_text(self):
@@ -12,6 +12,9 @@ class AnnualStat(models.Model):
     def __str__(self):
         return '{} {:.1f}mm  [{}]'.format(self.name, self.percip, self.last_update.strftime('%m/%d %H:%M'))
 
+    class Meta:
+        unique_together = ('name', 'year')
+
 
 class DailyStat(models.Model):
 
@@ -26,3 +29,27 @@ class DailyStat(models.Model):
 
     class Meta:
         get_latest_by = 'date'
+        # The unique constraint also serves as the (name, date) index
+        unique_together = ('name', 'date')
+        indexes = [models.Index(fields=['date'])]
+
+
+class MonthlyStat(models.Model):
+    """Per station monthly rollup of DailyStat, refreshed by psche."""
+
+    code = models.CharField(max_length=10)
+    name = models.CharField(max_length=32)
+    year = models.IntegerField()
+    month = models.IntegerField()
+    percip = models.DecimalField(max_digits=6, decimal_places=2, default=0, blank=True)
+    max_percip = models.DecimalField(max_digits=5, decimal_places=2, default=0, blank=True)
+    max_date = models.DateField(null=True, blank=True)
+    rain_days = models.IntegerField(default=0)
+    last_update = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{}/{:02d} {} {:.1f}mm'.format(self.year, self.month, self.name, self.percip)
+
+    class Meta:
+        unique_together = ('name', 'year', 'month')
+        indexes = [models.Index(fields=['year', 'month'])]
@@ -21,10 +21,11 @@ import matplotlib.pyplot as plt
 import matplotlib.patches as mpatch
 import matplotlib.path as mpath
 
-from django.db.models import Max, Sum
+from django.db.models import F, Sum
 
 from precipstat.bot import RichTable, RichText, TybbsBot
-from precipstat.models import DailyStat
+from precipstat.models import DailyStat, MonthlyStat
+from precipstat.psche import ensure_monthly
 from precipstat.pstat import get_mean_value, get_month_percent
 
 logger = logging.getLogger('precipstat.monthlyrepo')
@@ -68,6 +69,7 @@ class MonthlyUpdate:
             self.set_month(year, month)
         else:
             self.set_last_month()
+        ensure_monthly(self.day.year)
         self.collect_daily()
         self.collect_ranking()
         self.collect_others()
@@ -92,7 +94,9 @@ class MonthlyUpdate:
 
     def collect_daily(self):
         month_days = len(self.dayrange)
-        entries = DailyStat.objects.filter(date__month=self.month, date__year=self.day.year)
+        first_day = self.day.replace(day=1)
+        entries = DailyStat.objects.filter(date__gte=first_day,
+            date__lt=first_day + datetime.timedelta(days=month_days))
         daily_data = self.data['daily']
         for entry in entries:
             if entry.name not in daily_data:
@@ -101,8 +105,8 @@ class MonthlyUpdate:
             daily_data[entry.name][day_index] = str(entry.percip) # Decimal is not JSON-compactible
 
     def collect_ranking(self):
-        entries = DailyStat.objects.filter(date__month=self.month,
-            date__year=self.day.year).values('name').annotate(sum=Sum('percip')).order_by('-sum')
+        entries = MonthlyStat.objects.filter(year=self.day.year,
+            month=self.month).order_by('-percip').values('name', sum=F('percip'))
         monthly_data = self.data['ranking']
         mean_data = self.data['mean']
         for i, entry in enumerate(entries):
@@ -117,9 +121,8 @@ class MonthlyUpdate:
 
     def collect_others(self):
         if self.month != 1:
-            last_day = self.day.replace(day=1) - datetime.timedelta(days=1)
-            entries = DailyStat.objects.filter(date__lte=last_day,
-                date__year=self.day.year).values('name').annotate(sum=Sum('percip'))
+            entries = MonthlyStat.objects.filter(year=self.day.year, month__lt=self.month) \
+                .values('name').annotate(sum=Sum('percip'))
             for entry in entries:
                 self.data['prev'][entry['name']] = str(entry['sum'])
 
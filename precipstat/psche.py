@@ -1,24 +1,57 @@
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import date, timedelta
 
-from precipstat.models import AnnualStat, DailyStat
-from precipstat.pstat import get_percip_ogimet
+import requests
+from django.db import IntegrityError, transaction
+from django.db.models import OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, ExtractMonth
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from precipstat.models import AnnualStat, DailyStat, MonthlyStat
+from precipstat.pstat import (OGIMET_CONCURRENCY, OGIMET_SPAN, get_percip_ogimet,
+                              get_percip_ogimet_range)
 
 
 __file_dir = os.path.dirname(os.path.abspath(__file__))
 logger = logging.getLogger(__name__)
+_local = threading.local()
+
+def read_stations():
+    with open(os.path.join(__file_dir, 'stations.txt')) as f:
+        return [tuple(line.split()) for line in f if line.strip()]
+
+def fetch_list(stations, date):
+    """Fetch percip of all stations concurrently, None for failed ones."""
+    def fetch(station):
+        code, name = station
+        try:
+            return get_percip_ogimet(code, date.year, date.month, date.day)
+        except requests.exceptions.RequestException as err:
+            logger.warn("Get {} percip error: {}".format(name, err))
+            return None
+    with ThreadPoolExecutor(max_workers=OGIMET_CONCURRENCY) as executor:
+        return list(executor.map(fetch, stations))
 
 def update_list(date):
-    f = open(os.path.join(__file_dir, 'stations.txt'))
-    for line in f:
-        code, name = tuple(line.split())
-        percip = get_percip_ogimet(code, date.year, date.month, date.day)
-        if percip is None:
-            logger.warn("Get {} percip failed.".format(name))
-            continue
-        update_station(code, name, date, percip)
-    f.close()
+    stations = read_stations()
+    tic = time.time()
+    results = fetch_list(stations, date)
+    logger.info("Fetched {} stations in {:.1f}s".format(len(stations), time.time() - tic))
+    keys = []
+    with transaction.atomic(), deferred_totals():
+        for (code, name), percip in zip(stations, results):
+            if percip is None:
+                logger.warn("Get {} percip failed.".format(name))
+                continue
+            keys.append(save_daily(code, name, date, percip))
+        refresh_totals(keys)
         
 def update_today():
     update_list(date.today())
@@ -30,63 +63,163 @@ def update_single_station(code, name, date):
         return
     update_station(code, name, date, percip)
 
-def update_station(code, name, report_date, percip):
+def save_daily(code, name, report_date, percip):
+    """Store the percip of `report_date` 00Z report as the day before, return
+    the (code, name, date) whose totals need refreshing."""
     date = report_date - timedelta(days=1)
     logger.info("GET {} {} {:.1f}mm".format(name, date.strftime('%Y%m%d'), percip))
+    DailyStat.objects.update_or_create(name=name, date=date,
+        defaults={'code': code, 'percip': percip})
+    return code, name, date
+
+@contextmanager
+def deferred_totals():
+    """Skip the per row refresh of the DailyStat receivers below, the caller
+    refreshes the totals of the whole batch with refresh_totals."""
+    _local.deferred = True
     try:
-        daily_value = DailyStat.objects.get(name=name, date=date)
-    except DailyStat.DoesNotExist:
-        pass
-    else:
-        return _update_station_existed(code, name, date, percip, daily_value)
-    DailyStat.objects.create(code=code, name=name, percip=percip, date=date)
-    try:
-        annual_value = AnnualStat.objects.get(name=name, year=date.year)
-    except AnnualStat.DoesNotExist:
-        annual_value = AnnualStat.objects.create(code=code, name=name, year=date.year)
-    annual_value.percip = float(annual_value.percip) + percip
-    logger.info("UPDATE {} annual {:.1f}mm".format(name, annual_value.percip))
-    annual_value.save()
-
-def _update_station_existed(code, name, date, percip, prev_val):
-    prev_percip = float(prev_val.percip)
-    prev_val.percip = percip
-    prev_val.save()
-    annual_val = AnnualStat.objects.get(name=name, year=date.year)
-    annual_val.percip = float(annual_val.percip) - prev_percip + percip
-    logger.info("UPDATE {} annual {:.1f}mm".format(name, annual_val.percip))
-    annual_val.save()
+        yield
+    finally:
+        _local.deferred = False
+
+@receiver(post_save, sender=DailyStat)
+@receiver(post_delete, sender=DailyStat)
+def refresh_daily_totals(sender, instance, raw=False, **kwargs):
+    """Keep the totals in step with single edits, e.g. from the admin."""
+    if raw or getattr(_local, 'deferred', False):
+        return
+    refresh_totals([(instance.code, instance.name, instance.date)])
+
+def refresh_totals(keys):
+    """Refresh monthly and annual totals touched by (code, name, date) keys."""
+    keys = list(keys)
+    refresh_monthly((code, name, date.year, date.month) for code, name, date in keys)
+    refresh_annual((code, name, date.year) for code, name, date in keys)
+
+def refresh_monthly(keys):
+    """Rebuild MonthlyStat of (code, name, year, month) keys from one DailyStat
+    query, replacing the rows with one delete and one bulk insert. Months left
+    without any DailyStat lose their row."""
+    keys = set(keys)
+    if not keys:
+        return
+    daily_query = Q()
+    monthly_query = Q()
+    for code, name, year, month in keys:
+        start = date(year, month, 1)
+        end = date(year + month // 12, month % 12 + 1, 1)
+        daily_query |= Q(name=name, date__gte=start, date__lt=end)
+        monthly_query |= Q(name=name, year=year, month=month)
+    stats = {(name, year, month): MonthlyStat(code=code, name=name, year=year, month=month)
+        for code, name, year, month in keys}
+    for name, day, percip in DailyStat.objects.filter(daily_query) \
+            .values_list('name', 'date', 'percip').order_by('date'):
+        stat = stats[(name, day.year, day.month)]
+        stat.percip += percip
+        if percip > 0:
+            stat.rain_days += 1
+        if stat.max_date is None or percip >= stat.max_percip:
+            stat.max_percip, stat.max_date = percip, day
+    MonthlyStat.objects.filter(monthly_query).delete()
+    MonthlyStat.objects.bulk_create(stat for stat in stats.values() if stat.max_date is not None)
+
+def rebuild_monthly(year):
+    """Populate MonthlyStat of a whole year, e.g. for a freshly created table."""
+    keys = DailyStat.objects.filter(date__year=year).values_list('code', 'name', 'date')
+    with transaction.atomic():
+        refresh_monthly((code, name, day.year, day.month) for code, name, day in keys)
+
+def ensure_monthly(year):
+    """Rebuild MonthlyStat of `year` unless it has a row for every station
+    month found in DailyStat, e.g. right after the table was created."""
+    expected = DailyStat.objects.filter(date__year=year).annotate(month=ExtractMonth('date')) \
+        .values('name', 'month').distinct().count()
+    if MonthlyStat.objects.filter(year=year).count() != expected:
+        logger.info("Rebuilding monthly stats of {}".format(year))
+        rebuild_monthly(year)
+
+def refresh_annual(keys):
+    """Recompute AnnualStat of (code, name, year) keys as the SUM of their
+    DailyStat in one UPDATE, so totals never drift with reruns."""
+    keys = set(keys)
+    if not keys:
+        return
+    query = Q()
+    for code, name, year in keys:
+        query |= Q(name=name, year=year)
+    existing = set(AnnualStat.objects.filter(query).values_list('name', 'year'))
+    for code, name, year in keys:
+        if (name, year) in existing:
+            continue
+        try:
+            with transaction.atomic():
+                AnnualStat.objects.create(code=code, name=name, year=year)
+        except IntegrityError:
+            # Another run created it meanwhile, the UPDATE below covers it
+            pass
+    total = DailyStat.objects.filter(name=OuterRef('name'), date__year=OuterRef('year')) \
+        .order_by().values('name').annotate(total=Sum('percip')).values('total')
+    percip_field = AnnualStat._meta.get_field('percip')
+    AnnualStat.objects.filter(query).update(percip=Coalesce(
+        Subquery(total, output_field=percip_field), Value(0), output_field=percip_field),
+        last_update=timezone.now())
+    for annual_value in AnnualStat.objects.filter(query):
+        logger.info("UPDATE {} annual {:.1f}mm".format(annual_value.name, annual_value.percip))
+
+def update_station(code, name, report_date, percip):
+    with transaction.atomic():
+        save_daily(code, name, report_date, percip)
 
 def update(year, month, day):
     update_list(date(year, month, day))
 
+def find_missing(name, end):
+    """Return dates of this year up to `end` without a DailyStat, in one query."""
+    start = date(end.year, 1, 1)
+    existing = set(DailyStat.objects.filter(name=name, date__gte=start, date__lte=end)
+        .values_list('date', flat=True))
+    alldays = (start + timedelta(days=i) for i in range((end - start).days + 1))
+    return [day for day in alldays if day not in existing]
+
+def backfill(code, name, missing):
+    """Fill `missing` dates with one ogimet request per OGIMET_SPAN days."""
+    report_dates = [day + timedelta(days=1) for day in missing]
+    values = {}
+    i = 0
+    while i < len(report_dates):
+        start = report_dates[i]
+        end = start + timedelta(days=OGIMET_SPAN - 1)
+        j = i
+        while j + 1 < len(report_dates) and report_dates[j + 1] <= end:
+            j += 1
+        try:
+            values.update(get_percip_ogimet_range(code, start, report_dates[j]))
+        except requests.exceptions.RequestException as err:
+            logger.warn("Get {} percip error: {}".format(name, err))
+        i = j + 1
+    keys = []
+    with transaction.atomic(), deferred_totals():
+        for report_date in report_dates:
+            percip = values.get(report_date)
+            if percip is None:
+                logger.warn("Get {} percip on {} failed.".format(name,
+                    report_date.strftime('%Y%m%d')))
+                continue
+            keys.append(save_daily(code, name, report_date, percip))
+        refresh_totals(keys)
+
 def search_missing(code, name, fill=False):
     today = date.today() - timedelta(days=1)
-    annual_count = DailyStat.objects.filter(date__year=today.year, name=name).count()
-    yday = today.timetuple().tm_yday
-    if annual_count == yday:
+    missing = find_missing(name, today)
+    if not missing:
         logger.info('No missing value found for {}'.format(name))
         return
-    missing_days = yday - annual_count
-    logger.info("{} missing days for {}.".format(missing_days, name))
-    found_days = 0
-    for i in range(yday):
-        search_date = today - timedelta(days=i)
-        try:
-            DailyStat.objects.get(name=name, date=search_date)
-        except DailyStat.DoesNotExist:
-            logger.info("Found missing values for {} on {}.".format(name, search_date.strftime('%Y%m%d')))
-            if fill:
-                logger.info("Try to fill...")
-                update_single_station(code, name, search_date)
-            found_days += 1
-            logger.debug("Found days: {}".format(found_days))
-            if found_days == missing_days:
-                break
+    logger.info("{} missing days for {}: {}".format(len(missing), name,
+        ' '.join(day.strftime('%Y%m%d') for day in missing)))
+    if fill:
+        logger.info("Try to fill...")
+        backfill(code, name, missing)
 
 def search_missing_list(fill=True):
-    f = open(os.path.join(__file_dir, 'stations.txt'))
-    for line in f:
-        code, name = tuple(line.split())
+    for code, name in read_stations():
         search_missing(code, name, fill=fill)
-    f.close()
@@ -1,11 +1,48 @@
 import json
 import os
 import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date, timedelta
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from precipstat.synop import Synop, find_reports
 
 CWD = os.path.dirname(os.path.abspath(__file__))
 MEANVALUES = json.load(open(os.path.join(CWD, 'mean.json'), encoding='utf8'))
+OGIMET_CONCURRENCY = 4 # simultaneous requests to ogimet
+OGIMET_INTERVAL = 0.2 # in seconds, minimum spacing between request starts
+OGIMET_SPAN = 28 # in days, longest range fetched in one request
+TIMEOUT = 15 # in seconds
+PRE_BLOCK = re.compile('<b><pre>([^<>]*)</pre></b>')
+
+
+class HostThrottle:
+    """Limit concurrent requests to one host and space out their starts."""
+
+    def __init__(self, concurrency, interval):
+        self.interval = interval
+        self.next_time = 0
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def slot(self):
+        with self.slots:
+            with self._lock:
+                wait = self.next_time - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                self.next_time = time.time() + self.interval
+            yield
+
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_maxsize=OGIMET_CONCURRENCY))
+ogimet_throttle = HostThrottle(OGIMET_CONCURRENCY, OGIMET_INTERVAL)
 
 def get_percip_meteomanz(station_code, year, month, day):
     base_url = 'http://www.meteomanz.com/sy1'
@@ -22,21 +59,15 @@ def get_percip_meteomanz(station_code, year, month, day):
         'h1': '00Z',
         'h2': '00Z'
     }
-    res = requests.get(base_url, params=params)
+    res = session.get(base_url, params=params, timeout=TIMEOUT)
     match = re.search('<p><br>(.*)<br><br>', res.content.decode('utf8'))
     if match is None or match.group(1) is None:
         return None
-    synop = match.group(1)
-    match = re.search('333 7([0-9]{4})', synop)
-    if match is None or match.group(1) is None:
-        return 0
-    precip = match.group(1)
-    precip = int(precip) / 10
-    if percip > 950:
-        return 0
-    return precip
+    return percip_from_synop(match.group(1).replace('<br>', ' '))
 
-def get_percip_ogimet(station_code, year, month, day):
+def fetch_ogimet(station_code, start, end):
+    """Return the SYNOP reports of a station from `start` to `end` 00Z, as
+    listed by ogimet. The first <pre> block is the station header."""
     base_url = 'https://www.ogimet.com/display_synops2.php'
     params = {
         'lang': 'en',
@@ -45,29 +76,54 @@ def get_percip_ogimet(station_code, year, month, day):
         'ord': 'REV',
         'nil': 'Sl',
         'fmt': 'html',
-        'ano': year,
-        'mes': '{:02d}'.format(month),
-        'day': '{:02d}'.format(day),
+        'ano': start.year,
+        'mes': '{:02d}'.format(start.month),
+        'day': '{:02d}'.format(start.day),
         'hora': '00',
-        'anof': year,
-        'mesf': '{:02d}'.format(month),
-        'dayf': '{:02d}'.format(day),
+        'anof': end.year,
+        'mesf': '{:02d}'.format(end.month),
+        'dayf': '{:02d}'.format(end.day),
         'horaf': '00',
         'send': 'send'
     }
-    res = requests.get(base_url, params=params)
-    match = re.findall('<b><pre>([^<>]*)</pre></b>', res.content.decode('utf8').replace('\n', ''))
+    with ogimet_throttle.slot():
+        res = session.get(base_url, params=params, timeout=TIMEOUT)
+    return PRE_BLOCK.findall(res.content.decode('utf8'))
+
+def percip_from_synop(text):
+    """24h precipitation of the first report in `text`, 0 without a 7RRRR group."""
+    reports = find_reports(text)
+    synop = reports[0] if reports else Synop(text)
+    percip = synop.precip24
+    return 0.0 if percip is None else percip
+
+def get_percip_ogimet(station_code, year, month, day):
+    report_date = date(year, month, day)
+    match = fetch_ogimet(station_code, report_date, report_date)
     if len(match) != 2:
         return None
-    synop = match[1].replace('\n', '')
-    match = re.search('333.*7([0-9]{4}).*=', synop)
-    if match is None or match.group(1) is None:
-        return 0.0
-    percip = match.group(1)
-    percip = int(percip) / 10
-    if percip > 950:
-        return 0.0
-    return percip
+    return percip_from_synop(match[1])
+
+def get_percip_ogimet_range(station_code, start, end):
+    """Return {date: percip} of every 00Z report from `start` to `end` in one
+    request. The span must not exceed OGIMET_SPAN so that the day of month in
+    the AAXX group identifies the date."""
+    if (end - start).days >= OGIMET_SPAN:
+        raise ValueError('Span too long: {} - {}'.format(start, end))
+    dates = {}
+    for i in range((end - start).days + 1):
+        day = start + timedelta(days=i)
+        dates[day.day] = day
+    values = {}
+    for block in fetch_ogimet(station_code, start, end)[1:]:
+        for synop in find_reports(block):
+            if synop.hour != 0:
+                continue
+            report_date = dates.get(synop.day)
+            if report_date is not None:
+                percip = synop.precip24
+                values[report_date] = 0.0 if percip is None else percip
+    return values
 
 def get_mean_value(city, month):
     return MEANVALUES[city]['month'][month-1]
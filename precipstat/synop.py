@@ -0,0 +1,120 @@
+import re
+
+REPORT = re.compile(r'AAXX\s+[0-9/]{5}\s+[^=]*=')
+SECTION_MARKERS = {'333': 3, '444': 4, '555': 5}
+PRECIP_HOURS = {'1': 6, '2': 12, '3': 18, '4': 24, '5': 1, '6': 2, '7': 3, '8': 9, '9': 15}
+
+
+def decode_rrr(rrr):
+    """Amount of a 6RRRt group in mm, 990 is a trace and 991-999 are tenths."""
+    if not rrr.isdigit():
+        return None
+    value = int(rrr)
+    if value == 990:
+        return 0.0
+    if value > 990:
+        return (value - 990) / 10
+    return float(value)
+
+def decode_temp(group):
+    """Temperature of a 1sTTT/2sTTT style group in degree Celsius."""
+    sign, ttt = group[1], group[2:]
+    if sign not in '01' or not ttt.isdigit():
+        return None
+    value = int(ttt) / 10
+    return -value if sign == '1' else value
+
+
+class Synop:
+    """A FM-12 SYNOP report tokenised once into sections of 5-char groups.
+    Section 0 holds the AAXX/YYGGi/IIiii header, section 1 the positional
+    iRiXhVV and Nddff(00fff) groups followed by the indicator groups.
+    `day` and `hour` are ints, YY has 50 added when wind is given in knots."""
+
+    def __init__(self, text):
+        self.text = text
+        tokens = text.replace('=', ' ').split()
+        if tokens and tokens[0] == 'AAXX':
+            tokens = tokens[1:]
+        self.sections = {0: tokens[:2], 1: []}
+        self.day = self.hour = self.station = None
+        self.wind_knots = False
+        if len(tokens) >= 2:
+            yy, gg = tokens[0][:2], tokens[0][2:4]
+            if yy.isdigit() and gg.isdigit():
+                self.day, self.hour = int(yy), int(gg)
+                if self.day > 50:
+                    self.day -= 50
+                    self.wind_knots = True
+            self.station = tokens[1]
+        section = self.sections[1]
+        for token in tokens[2:]:
+            if token in SECTION_MARKERS:
+                section = self.sections.setdefault(SECTION_MARKERS[token], [])
+            elif token.startswith('222') and len(token) == 5 and 2 not in self.sections:
+                section = self.sections.setdefault(2, [token])
+            else:
+                section.append(token)
+
+    def groups(self, section):
+        groups = self.sections.get(section, [])
+        if section == 1:
+            skip = 2
+            if len(groups) > 1 and groups[1][-2:] == '99':
+                skip = 3 # wind speed over 99 units in a 00fff group
+            groups = groups[skip:]
+        return groups
+
+    def group(self, section, indicator):
+        """First group of `section` starting with `indicator`, or None."""
+        for group in self.groups(section):
+            if group[0] == indicator and len(group) == 5:
+                return group
+        return None
+
+    @property
+    def precip24(self):
+        """24 hour precipitation from the 333 7RRRR group, None if absent."""
+        group = self.group(3, '7')
+        if group is None or not group[1:].isdigit():
+            return None
+        if group[1:] == '9999':
+            return 0.0 # trace
+        return int(group[1:]) / 10
+
+    @property
+    def precip(self):
+        """List of (hours, mm) from the 6RRRt groups of section 1 and 3."""
+        values = []
+        for section in (1, 3):
+            for group in self.groups(section):
+                if group[0] == '6' and len(group) == 5 and group[4] in PRECIP_HOURS:
+                    value = decode_rrr(group[1:4])
+                    if value is not None:
+                        values.append((PRECIP_HOURS[group[4]], value))
+        return values
+
+    @property
+    def temperature(self):
+        group = self.group(1, '1')
+        return decode_temp(group) if group else None
+
+    @property
+    def dewpoint(self):
+        group = self.group(1, '2')
+        return decode_temp(group) if group else None
+
+    @property
+    def max_temp(self):
+        group = self.group(3, '1')
+        return decode_temp(group) if group else None
+
+    @property
+    def min_temp(self):
+        group = self.group(3, '2')
+        return decode_temp(group) if group else None
+
+
+def find_reports(text):
+    """Return a Synop for every AAXX ... = report found in `text`."""
+    return [Synop(match.group(0)) for match in REPORT.finditer(text)]
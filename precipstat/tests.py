@@ -0,0 +1,178 @@
+import os
+from datetime import date
+from decimal import Decimal
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase
+
+from precipstat import psche, pstat
+from precipstat.models import AnnualStat, DailyStat, MonthlyStat
+from precipstat.synop import Synop, find_reports
+
+TESTDATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'testdata')
+
+
+def read_page(filename):
+    with open(os.path.join(TESTDATA, filename), encoding='utf8') as f:
+        return f.read()
+
+
+class SynopTests(SimpleTestCase):
+
+    def test_precip24(self):
+        synop = Synop('AAXX 01001 59287 32966 60000 10239 20224 60104 333 10276 70125 91102=')
+        self.assertEqual(synop.day, 1)
+        self.assertEqual(synop.hour, 0)
+        self.assertEqual(synop.station, '59287')
+        self.assertEqual(synop.precip24, 12.5)
+
+    def test_later_group_starting_with_7(self):
+        # The legacy '333.*7([0-9]{4}).*=' pattern read 1700.1mm from 555 17001
+        synop = Synop('AAXX 03001 59287 32966 80000 10241 333 10290 70426 91102 555 17001=')
+        self.assertEqual(synop.precip24, 42.6)
+
+    def test_no_7rrrr_group(self):
+        synop = Synop('AAXX 02001 59287 32966 30000 10252 333 10301 56999 91102 555 17001=')
+        self.assertIsNone(synop.precip24)
+
+    def test_trace(self):
+        synop = Synop('AAXX 04001 59287 32966 20000 10235 333 10285 79999=')
+        self.assertEqual(synop.precip24, 0.0)
+
+    def test_6rrrt(self):
+        synop = Synop('AAXX 03061 59287 32966 80000 10268 60102 333 69971 71234=')
+        self.assertEqual(synop.precip, [(12, 10.0), (6, 0.7)])
+
+    def test_00fff_skipped(self):
+        # Wind of 99 units or more moves the speed into a 00fff group
+        synop = Synop('AAXX 01001 59287 32966 80599 00120 10241 20230 60104 333 70030=')
+        self.assertEqual(synop.temperature, 24.1)
+        self.assertEqual(synop.dewpoint, 23.0)
+        self.assertEqual(synop.precip, [(24, 10.0)])
+
+    def test_wind_in_knots(self):
+        synop = Synop('AAXX 51004 59287 32966 80000 10241 333 70030=')
+        self.assertEqual(synop.day, 1)
+        self.assertTrue(synop.wind_knots)
+
+    def test_temperatures(self):
+        synop = Synop('AAXX 01001 59287 32966 60000 11012 21034 333 10276 21005=')
+        self.assertEqual(synop.temperature, -1.2)
+        self.assertEqual(synop.dewpoint, -3.4)
+        self.assertEqual(synop.max_temp, 27.6)
+        self.assertEqual(synop.min_temp, -0.5)
+
+    def test_find_reports(self):
+        reports = find_reports('x AAXX 01001 59287 32966 333 70011= y AAXX 02001 59287 32966=')
+        self.assertEqual([r.day for r in reports], [1, 2])
+
+
+class PageTests(SimpleTestCase):
+
+    def test_ogimet_range(self):
+        blocks = pstat.PRE_BLOCK.findall(read_page('ogimet_59287.html'))
+        with mock.patch.object(pstat, 'fetch_ogimet', return_value=blocks):
+            values = pstat.get_percip_ogimet_range('59287', date(2019, 5, 1), date(2019, 5, 4))
+        self.assertEqual(values, {
+            date(2019, 5, 1): 12.5,
+            date(2019, 5, 2): 0.0,
+            date(2019, 5, 3): 42.6,
+            date(2019, 5, 4): 0.0,
+        })
+
+    def test_ogimet_single(self):
+        blocks = pstat.PRE_BLOCK.findall(read_page('ogimet_59287.html'))
+        with mock.patch.object(pstat, 'fetch_ogimet', return_value=blocks[:1] + blocks[-1:]):
+            self.assertEqual(pstat.get_percip_ogimet('59287', 2019, 5, 1), 12.5)
+
+    def test_meteomanz(self):
+        response = mock.Mock(content=read_page('meteomanz_59287.html').encode('utf8'))
+        with mock.patch.object(pstat.session, 'get', return_value=response):
+            self.assertEqual(pstat.get_percip_meteomanz('59287', 2019, 5, 3), 42.6)
+
+
+class PscheTests(TestCase):
+    """Reports are stored as the day before `report_date`."""
+
+    def annual(self, name, year):
+        return AnnualStat.objects.get(name=name, year=year).percip
+
+    def monthly(self, name, year, month):
+        return MonthlyStat.objects.filter(name=name, year=year, month=month) \
+            .values_list('percip', 'max_percip', 'max_date', 'rain_days').get()
+
+    def test_rerun_overwrites(self):
+        psche.update_station('59287', 'Guangzhou', date(2019, 5, 2), 12.5)
+        psche.update_station('59287', 'Guangzhou', date(2019, 5, 2), 3.0)
+        self.assertEqual(DailyStat.objects.filter(name='Guangzhou').count(), 1)
+        self.assertEqual(self.annual('Guangzhou', 2019), Decimal('3.0'))
+        self.assertEqual(self.monthly('Guangzhou', 2019, 5),
+            (Decimal('3.0'), Decimal('3.0'), date(2019, 5, 1), 1))
+
+    def test_out_of_order(self):
+        values = [(date(2019, 5, 2), 12.5), (date(2019, 5, 3), 0.0), (date(2019, 5, 4), 42.6),
+            (date(2019, 6, 2), 7.0)]
+        for report_date, percip in values:
+            psche.update_station('59287', 'Guangzhou', report_date, percip)
+        for report_date, percip in reversed(values):
+            psche.update_station('59316', 'Shantou', report_date, percip)
+        self.assertEqual(self.annual('Shantou', 2019), self.annual('Guangzhou', 2019))
+        self.assertEqual(self.annual('Shantou', 2019), Decimal('62.1'))
+        for month in (5, 6):
+            self.assertEqual(self.monthly('Shantou', 2019, month),
+                self.monthly('Guangzhou', 2019, month))
+        self.assertEqual(self.monthly('Shantou', 2019, 5),
+            (Decimal('55.1'), Decimal('42.6'), date(2019, 5, 3), 2))
+
+    def test_year_boundary(self):
+        psche.update_station('59287', 'Guangzhou', date(2019, 12, 31), 1.5)
+        psche.update_station('59287', 'Guangzhou', date(2020, 1, 1), 2.0)
+        psche.update_station('59287', 'Guangzhou', date(2020, 1, 2), 4.0)
+        self.assertEqual(self.annual('Guangzhou', 2019), Decimal('3.5'))
+        self.assertEqual(self.annual('Guangzhou', 2020), Decimal('4.0'))
+        self.assertEqual(self.monthly('Guangzhou', 2019, 12),
+            (Decimal('3.5'), Decimal('2.0'), date(2019, 12, 31), 2))
+        self.assertEqual(self.monthly('Guangzhou', 2020, 1),
+            (Decimal('4.0'), Decimal('4.0'), date(2020, 1, 1), 1))
+
+
+class RollupTests(TestCase):
+
+    def setUp(self):
+        for report_date, percip in ((date(2019, 5, 2), 12.5), (date(2019, 5, 3), 0.0),
+                (date(2019, 6, 2), 7.0), (date(2019, 7, 2), 1.0)):
+            psche.update_station('59287', 'Guangzhou', report_date, percip)
+
+    def rollup(self):
+        return list(MonthlyStat.objects.order_by('name', 'year', 'month').values_list('name',
+            'year', 'month', 'percip', 'max_percip', 'max_date', 'rain_days'))
+
+    def test_rebuild_from_empty(self):
+        expected = self.rollup()
+        self.assertEqual(len(expected), 3)
+        MonthlyStat.objects.all().delete()
+        psche.ensure_monthly(2019)
+        self.assertEqual(self.rollup(), expected)
+
+    def test_count_mismatch(self):
+        expected = self.rollup()
+        with mock.patch.object(psche, 'rebuild_monthly') as rebuild:
+            psche.ensure_monthly(2019)
+        rebuild.assert_not_called()
+        MonthlyStat.objects.filter(month=6).delete()
+        psche.ensure_monthly(2019)
+        self.assertEqual(self.rollup(), expected)
+
+    def test_edit_after_rollup(self):
+        daily = DailyStat.objects.get(name='Guangzhou', date=date(2019, 5, 2))
+        daily.percip = Decimal('20.0')
+        daily.save()
+        stat = MonthlyStat.objects.get(name='Guangzhou', year=2019, month=5)
+        self.assertEqual((stat.percip, stat.max_date, stat.rain_days),
+            (Decimal('32.5'), date(2019, 5, 2), 2))
+        self.assertEqual(AnnualStat.objects.get(name='Guangzhou', year=2019).percip,
+            Decimal('40.5'))
+        DailyStat.objects.get(name='Guangzhou', date=date(2019, 6, 1)).delete()
+        self.assertFalse(MonthlyStat.objects.filter(name='Guangzhou', month=6).exists())
+        self.assertEqual(AnnualStat.objects.get(name='Guangzhou', year=2019).percip,
+            Decimal('33.5'))
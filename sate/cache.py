@@ -0,0 +1,22 @@
+import os
+
+import numpy as np
+
+
+def save_npy(path, arr):
+    """Save through a private temp file, so that readers never see a partial array."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '{}.{}.npy'.format(path[:-4], os.getpid())
+    np.save(tmp_path, arr)
+    os.replace(tmp_path, path)
+
+def load_or_build(path, build, source=None, mmap_mode=None):
+    """Load the array cached at `path`, or `build()` and cache it. A cache older
+    than the `source` file is rebuilt. No caching if `path` is None."""
+    if path and os.path.exists(path) and (source is None or
+            os.path.getmtime(path) >= os.path.getmtime(source)):
+        return np.load(path, mmap_mode=mmap_mode)
+    arr = build()
+    if path:
+        save_npy(path, arr)
+    return arr
@@ -1,8 +1,17 @@
 import os
 
+import matplotlib.colors as mclr
+import matplotlib.pyplot as plt
+import numpy as np
 from matplotlib.colors import LinearSegmentedColormap as LSCMAP
 
+from sate.cache import load_or_build
+
 _local_dir_ = os.path.dirname(__file__)
+_lut_cache_ = {}
+
+LUT_SIZE = 1501 # 0.1 degC steps over LUT_SCALE
+LUT_SCALE = (-100, 50)
 
 def parse_colormap_line(line):
     lineinfo = {'temp':255, 'r':[], 'b':[], 'g':[], 'status':0}
@@ -97,3 +106,47 @@ def get_colormap(name):
         return 0
     vmin, vmax, colormap = parse_colormap(data)
     return LSCMAP(name, colormap)
+
+def compile_lut(cmap, vmin, vmax, scale=LUT_SCALE, bgcolor='none', size=LUT_SIZE):
+    """Evaluate `cmap` normalized to [vmin, vmax] at every step of `scale` into
+    a uint8 RGBA table. The extra last row holds `bgcolor` for masked pixels."""
+    values = np.linspace(scale[0], scale[1], size)
+    lut = np.empty((size + 1, 4), dtype='u1')
+    lut[:size] = cmap(np.clip((values - vmin) / (vmax - vmin), 0, 1), bytes=True)
+    lut[size] = np.rint(np.array(mclr.to_rgba(bgcolor)) * 255)
+    return lut
+
+def get_lut(name, vmin=-100, vmax=50, scale=LUT_SCALE, bgcolor='none', cache_dir=None):
+    """Return the compiled LUT of colormap file `name`, or of a matplotlib
+    colormap if there is no such file. LUTs are cached per process and, if
+    `cache_dir` is given, on disk."""
+    key = (name, vmin, vmax, tuple(scale), bgcolor)
+    if key in _lut_cache_:
+        return _lut_cache_[key]
+    filepath = os.path.join(_local_dir_, 'colormap/{}.txt'.format(name.lower()))
+    is_file = os.path.exists(filepath)
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, 'lut_{}_{}_{}_{}_{}_{}.npy'.format(name, vmin, vmax,
+            scale[0], scale[1], bgcolor.strip('#')))
+    def build():
+        cmap = get_colormap(name) if is_file else plt.get_cmap(name)
+        return compile_lut(cmap, vmin, vmax, scale=scale, bgcolor=bgcolor)
+    lut = load_or_build(cache_path, build, source=filepath if is_file else None)
+    _lut_cache_[key] = lut
+    return lut
+
+def quantize(data, scale=LUT_SCALE, size=LUT_SIZE):
+    """Map data onto LUT indices over `scale`. Masked or invalid pixels get the
+    extra index `size`."""
+    lower, upper = scale
+    values = np.ma.getdata(data)
+    bad = np.ma.getmaskarray(data) | ~np.isfinite(values)
+    index = np.rint((np.where(bad, lower, values) - lower) * ((size - 1) / (upper - lower)))
+    index = np.clip(index, 0, size - 1).astype('i2')
+    index[bad] = size
+    return index
+
+def apply_lut(lut, index):
+    """Return the RGBA image of quantized `index`."""
+    return np.take(lut, index, axis=0)
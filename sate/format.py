@@ -1,40 +1,92 @@
-import numpy as np
 import bz2
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+from sate.cache import load_or_build
+
+CHUNK_SIZE = 1 << 20
+NAV_CACHE_SIZE = 8 # lon/lat grids kept in memory
+
+_nav_cache = {}
 
 class HimawariFormat:
 
-    def __init__(self, filename:str):
+    def __init__(self, filename:str, nav_cache_dir:str=None):
         self.filename = filename
+        self.nav_cache_dir = nav_cache_dir
 
     def extract(self):
         self.hsd, raw = self._extract()
         return self.calibration(self.hsd, raw)
 
     def get_geocoord(self):
-        return self.get_lonlat(self.hsd)
+        return self.get_cached_lonlat(self.hsd)
+
+    def nav_key(self, hsd):
+        """Navigation only depends on these header values, which rarely change."""
+        md5 = hashlib.md5()
+        md5.update(hsd['BLOCK_03'].tobytes())
+        md5.update(hsd['BLOCK_07']['FirstLineNumber'].tobytes())
+        md5.update(hsd['BLOCK_02']['NumberOfLines'].tobytes())
+        md5.update(np.array(hsd['ColumnBoundary'], dtype='i4').tobytes())
+        return md5.hexdigest()
+
+    def get_cached_lonlat(self, hsd):
+        key = self.nav_key(hsd)
+        if key in _nav_cache:
+            return _nav_cache[key]
+        path = os.path.join(self.nav_cache_dir, key + '.npy') if self.nav_cache_dir else None
+        def build():
+            lon, lat = self.get_lonlat(hsd)
+            return np.stack([lon.filled(np.nan), lat.filled(np.nan)])
+        grid = load_or_build(path, build, mmap_mode='r')
+        lonlat = np.ma.masked_invalid(grid[0]), np.ma.masked_invalid(grid[1])
+        if len(_nav_cache) >= NAV_CACHE_SIZE:
+            _nav_cache.pop(next(iter(_nav_cache)))
+        _nav_cache[key] = lonlat
+        return lonlat
+
+    def decompress(self):
+        """Decompress the segment once into a raw .DAT file next to it and return
+        its path. Later reads of the same segment map the cached file directly."""
+        if not self.filename.endswith('.bz2'):
+            return self.filename
+        raw_path = self.filename[:-4] + '.DAT'
+        if os.path.exists(raw_path) and os.path.getmtime(raw_path) >= os.path.getmtime(self.filename):
+            return raw_path
+        tmp_path = '{}.{}.tmp'.format(raw_path, os.getpid())
+        with bz2.open(self.filename, mode='rb') as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(tmp_path, raw_path)
+        return raw_path
 
     def _extract(self):
         hsd = {}
-        f = bz2.open(self.filename, mode='rb')
-        hsd['BLOCK_01'] = np.fromstring(f.read(282), dtype=self._BLOCK_01)
-        hsd['BLOCK_02'] = np.fromstring(f.read(50), dtype=self._BLOCK_02)
-        hsd['BLOCK_03'] = np.fromstring(f.read(127), dtype=self._BLOCK_03)
-        self.leap_block(f, 1)
-        hsd['BLOCK_05'] = np.fromstring(f.read(35), dtype=self._BLOCK_05)
+        raw_path = self.decompress()
+        buf = np.memmap(raw_path, dtype='u1', mode='r')
+        pos = 0
+        hsd['BLOCK_01'], pos = self.read_block(buf, pos, self._BLOCK_01)
+        hsd['BLOCK_02'], pos = self.read_block(buf, pos, self._BLOCK_02)
+        hsd['BLOCK_03'], pos = self.read_block(buf, pos, self._BLOCK_03)
+        pos = self.leap_block(buf, pos, 1)
+        hsd['BLOCK_05'], pos = self.read_block(buf, pos, self._BLOCK_05)
         if hsd['BLOCK_05']['BandNumber'] <= 6:
-            hsd['VisibleBand'] = np.fromstring(f.read(112), dtype=self._VisibleBand)
+            hsd['VisibleBand'], pos = self.read_block(buf, pos, self._VisibleBand)
         else:
-            hsd['InfraredBand'] = np.fromstring(f.read(112), dtype=self._InfraredBand)
-        self.leap_block(f, 1)
-        hsd['BLOCK_07'] = np.fromstring(f.read(47), dtype=self._BLOCK_07)
-        self.leap_block(f, 4)
+            hsd['InfraredBand'], pos = self.read_block(buf, pos, self._InfraredBand)
+        pos = self.leap_block(buf, pos, 1)
+        hsd['BLOCK_07'], pos = self.read_block(buf, pos, self._BLOCK_07)
+        pos = self.leap_block(buf, pos, 4)
         lines = hsd['BLOCK_02']['NumberOfLines'].item()
         columns = hsd['BLOCK_02']['NumberOfColumns'].item()
-        raw = np.ma.masked_greater(np.fromstring(f.read(), dtype='uint16').reshape((lines, columns)), 65530)
+        pixels = np.memmap(raw_path, dtype='uint16', mode='r', offset=pos, shape=(lines, columns))
+        raw = np.ma.masked_greater(pixels, 65530, copy=False)
         column_west = 0
         column_east = raw.shape[1]
         hsd['ColumnBoundary'] = (column_west, column_east)
-        f.close()
         return hsd, raw
 
     def calibration(self, hsd, raw):
@@ -89,10 +141,14 @@ class HimawariFormat:
         lats = np.ma.masked_outside(RADTODEG * np.arctan(CON * S3 / Sxy), -90., 90.)
         return np.ma.masked_invalid(lons), np.ma.masked_invalid(lats)
 
-    def leap_block(self, f, n):
+    def read_block(self, buf, pos, dtype):
+        return np.frombuffer(buf, dtype=dtype, count=1, offset=pos), pos + dtype.itemsize
+
+    def leap_block(self, buf, pos, n):
         for i in range(n):
-            tmparr = np.fromstring(f.read(3), dtype=self._Header)
-            f.seek(tmparr['BlockLength'].item()-3, 1)
+            tmparr = np.frombuffer(buf, dtype=self._Header, count=1, offset=pos)
+            pos += tmparr['BlockLength'].item()
+        return pos
 
     _BLOCK_01 = np.dtype([('HeaderBlockNumber', 'u1'),
                      ('BlockLength', 'u2'),
@@ -0,0 +1,113 @@
+import logging
+import os
+
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+from mpl_toolkits.basemap import Basemap
+
+from sate.cache import load_or_build
+
+matplotlib.use('agg')
+logger = logging.getLogger(__name__)
+
+DEGTORAD = np.pi / 180.
+RADTODEG = 180. / np.pi
+SCLUNIT = np.power(2., -16)
+
+_remapper_cache = {}
+_overlay_cache = {}
+
+
+class Remapper:
+    """Lookup table from a regular lon/lat target grid to pixels of an HSD
+    segment, so that reprojection is a single fancy-index."""
+
+    def __init__(self, georange, width, lut=None):
+        self.georange = georange
+        self.width = width
+        aspect = (georange[3] - georange[2]) / (georange[1] - georange[0])
+        self.height = int(round(width / aspect))
+        self.lut = lut
+
+    def target_grid(self):
+        """Return lon/lat of target pixel centres, the first row is the northmost."""
+        lat_min, lat_max, lon_min, lon_max = self.georange
+        dlon = (lon_max - lon_min) / self.width
+        dlat = (lat_max - lat_min) / self.height
+        lons = lon_min + (np.arange(self.width) + 0.5) * dlon
+        lats = lat_max - (np.arange(self.height) + 0.5) * dlat
+        return np.meshgrid(lons, lats)
+
+    def build(self, hsd):
+        """Invert the JMA navigation: find the nearest segment pixel of every
+        target pixel. Pixels outside the segment are set to -1."""
+        lons, lats = self.target_grid()
+        b3 = hsd['BLOCK_03']
+        lon = (lons - b3['SubLon']) * DEGTORAD
+        c_lat = np.arctan(b3['EarthConst2'] * np.tan(lats * DEGTORAD))
+        rl = b3['EarthPolarRadius'] / np.sqrt(1 - b3['EarthConst1'] * np.square(np.cos(c_lat)))
+        r1 = b3['Distance'] - rl * np.cos(c_lat) * np.cos(lon)
+        r2 = -rl * np.cos(c_lat) * np.sin(lon)
+        r3 = rl * np.sin(c_lat)
+        rn = np.sqrt(np.square(r1) + np.square(r2) + np.square(r3))
+        x = np.arctan2(-r2, r1) * RADTODEG
+        y = np.arcsin(-r3 / rn) * RADTODEG
+        columns = np.rint(b3['COFF'] + x * SCLUNIT * b3['CFAC']).astype('i8')
+        lines = np.rint(b3['LOFF'] + y * SCLUNIT * b3['LFAC']).astype('i8')
+        column_west, column_east = hsd['ColumnBoundary']
+        first_line = hsd['BLOCK_07']['FirstLineNumber'].item()
+        nlines = hsd['BLOCK_02']['NumberOfLines'].item()
+        ncolumns = column_east - column_west
+        columns -= column_west
+        lines -= first_line
+        inside = (columns >= 0) & (columns < ncolumns) & (lines >= 0) & (lines < nlines)
+        self.lut = np.where(inside, lines * ncolumns + columns, -1).astype('i4')
+        return self
+
+    def remap(self, data):
+        """Return `data` resampled onto the target grid as a masked array."""
+        valid = self.lut >= 0
+        idx = np.where(valid, self.lut, 0)
+        values = np.ma.getdata(data).ravel().take(idx)
+        mask = ~valid | np.ma.getmaskarray(data).ravel().take(idx)
+        return np.ma.array(values, mask=mask)
+
+    def overlay(self, dpi, grid=False):
+        """Render coastlines (and lat/lon lines) once as a transparent RGBA layer."""
+        fig = plt.figure(figsize=((self.width + 0.5) / dpi, (self.height + 0.5) / dpi), dpi=dpi)
+        ax = fig.add_axes([0, 0, 1, 1])
+        georange = self.georange
+        _map = Basemap(projection='cyl', llcrnrlat=georange[0], urcrnrlat=georange[1],
+            llcrnrlon=georange[2], urcrnrlon=georange[3], resolution='i', ax=ax)
+        _map.drawcoastlines(linewidth=0.4, color='w')
+        if grid:
+            _map.drawparallels(np.arange(-90,90,1), linewidth=0.2, dashes=(None, None),
+                color='w')
+            _map.drawmeridians(np.arange(0,360,1), linewidth=0.2, dashes=(None, None),
+                color='w')
+        ax.axis('off')
+        fig.patch.set_alpha(0)
+        fig.canvas.draw()
+        buf, (width, height) = fig.canvas.print_to_buffer()
+        plt.close(fig)
+        return np.frombuffer(buf, dtype='u1').reshape((height, width, 4))
+
+
+def get_remapper(nav_key, hsd, georange, width, cache_dir=None):
+    key = (nav_key, width)
+    if key not in _remapper_cache:
+        remapper = Remapper(georange, width)
+        path = os.path.join(cache_dir, '{}_lut{}.npy'.format(nav_key, width)) if cache_dir else None
+        remapper.lut = load_or_build(path, lambda: remapper.build(hsd).lut)
+        _remapper_cache[key] = remapper
+        logger.debug('Remapper ready: {}'.format(key))
+    return _remapper_cache[key]
+
+def get_overlay(nav_key, remapper, dpi, grid=False, cache_dir=None):
+    key = (nav_key, remapper.width, dpi, grid)
+    if key not in _overlay_cache:
+        path = os.path.join(cache_dir, '{}_overlay{}_{}{}.npy'.format(nav_key, remapper.width,
+            dpi, 'g' if grid else '')) if cache_dir else None
+        _overlay_cache[key] = load_or_build(path, lambda: remapper.overlay(dpi, grid=grid))
+    return _overlay_cache[key]
@@ -1,21 +1,26 @@
 import logging
 import os
 import shutil
+import time
 
 import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 from django.conf import settings
-from mpl_toolkits.basemap import Basemap
 
-from sate.colormap import get_colormap
+from sate.colormap import LUT_SCALE, apply_lut, get_lut, quantize
 from sate.format import HimawariFormat
+from sate.remap import get_overlay, get_remapper
 from sate.satefile import SateFile
 
 matplotlib.use('agg')
 matplotlib.rc('font', family='HelveticaNeue')
 logger = logging.getLogger(__name__)
 
+# Kept apart from TMP_ROOT/sate, whose older subdirs are removed by the cleaner
+NAV_CACHE_DIR = os.path.join(settings.TMP_ROOT, 'satenav')
+VIS_SCALE = (0, 1)
+
 
 class SateImage:
 
@@ -28,19 +33,24 @@ class SateImage:
         self.output_path = os.path.join(settings.MEDIA_ROOT, 'sate/{}/B{}{{enh}}/{}.png'.format(
             time.strftime('%Y%m%d'), self.satefile.band, time.strftime('%H%M')))
 
-    def load_colormap(self, name):
-        return get_colormap(name)
+    def load_lut(self, name, vmin, vmax, scale):
+        return get_lut(name, vmin, vmax, scale=scale, bgcolor=self.bgcolor,
+            cache_dir=NAV_CACHE_DIR)
         
     def imager(self):
         if os.path.getsize(self.satefile.target_path) < 100:
             logger.warning('Empty file: {}'.format(self.satefile.target_path))
             return
-        hf = HimawariFormat(self.satefile.target_path)
+        tic = time.time()
+        hf = HimawariFormat(self.satefile.target_path, nav_cache_dir=NAV_CACHE_DIR)
         data = hf.extract()
+        extract_toc = time.time()
         lons, lats = hf.get_geocoord()
         georange = lats.min(), lats.max(), lons.min(), lons.max()
-        aspect = (georange[3] - georange[2]) / (georange[1] - georange[0])
-        fig_width = self.imwidth / self.dpi
+        nav_key = hf.nav_key(hf.hsd)
+        remapper = get_remapper(nav_key, hf.hsd, georange, self.imwidth, cache_dir=NAV_CACHE_DIR)
+        data = remapper.remap(data)
+        remap_toc = time.time()
         if not isinstance(self.satefile.enhance, tuple):
             enhances = [self.satefile.enhance]
         else:
@@ -49,13 +59,24 @@ class SateImage:
         # VIS doesn't have enhancement
         if band <= 3:
             enhances = [None]
-        _map = Basemap(projection='cyl', llcrnrlat=georange[0], urcrnrlat=georange[1],
-            llcrnrlon=georange[2], urcrnrlon=georange[3], resolution='i')
+            data = np.sqrt(np.clip(data, 0, 1))
+            scale = VIS_SCALE
+        else:
+            scale = LUT_SCALE
+        # Quantize once, every enhancement is then a table lookup of the same index
+        index = quantize(data, scale)
+        fig = plt.figure(figsize=((remapper.width + 0.5) / self.dpi,
+            (remapper.height + 0.5) / self.dpi), dpi=self.dpi)
+        image = fig.figimage(np.zeros(index.shape + (4,), dtype='u1'), resize=False)
+        overlay = fig.figimage(np.zeros(index.shape + (4,), dtype='u1'), resize=False)
+        caption = fig.text(0.5, 0.003, '', va='bottom', ha='center',
+            bbox=dict(boxstyle='round', facecolor=self.bgcolor, pad=0.3, edgecolor='none'),
+            color='w', zorder=3, fontsize=6)
+        fig.text(0.997, 0.997, 'Commercial Use PROHIBITED', va='top', ha='right',
+            bbox=dict(boxstyle='round', facecolor=self.bgcolor, pad=0.3, edgecolor='none'),
+            color='w', zorder=3, fontsize=6)
         for enh in enhances:
-            fig = plt.figure(figsize=(fig_width, fig_width / aspect))
-            ax = fig.add_axes([0, 0, 1, 1])
             if band <= 3:
-                data = np.sqrt(np.clip(data, 0, 1))
                 cmap = 'gray'
                 vmin = 0
                 vmax = 1
@@ -64,33 +85,26 @@ class SateImage:
                 vmin = -80
                 vmax = 50
             else:
-                cmap = self.load_colormap(enh)
+                cmap = enh
                 vmin = -100
                 vmax = 50
-            _map.pcolormesh(lons, lats, data, latlon=True, cmap=cmap, vmin=vmin, vmax=vmax)
-            _map.drawcoastlines(linewidth=0.4, color='w')
-            if enh:
-                _map.drawparallels(np.arange(-90,90,1), linewidth=0.2, dashes=(None, None),
-                    color='w')
-                _map.drawmeridians(np.arange(0,360,1), linewidth=0.2, dashes=(None, None),
-                    color='w')
+            lut = self.load_lut(cmap, vmin, vmax, scale)
+            image.set_data(apply_lut(lut, index))
+            overlay.set_data(get_overlay(nav_key, remapper, self.dpi, grid=bool(enh),
+                cache_dir=NAV_CACHE_DIR))
             enh_str = '' if enh is None else enh
             enh_disp = '-' + enh_str if enh else ''
             cap = '{} HIMAWARI-8 BAND{:02d}{}'.format(self.satefile.time.strftime('%Y/%m/%d %H%MZ'),
                 band, enh_disp)
-            ax.text(0.5, 0.003, cap.upper(), va='bottom', ha='center', transform=ax.transAxes,
-                bbox=dict(boxstyle='round', facecolor=self.bgcolor, pad=0.3, edgecolor='none'),
-                color='w', zorder=3, fontsize=6)
-            ax.text(0.997, 0.997, 'Commercial Use PROHIBITED', va='top', ha='right',
-                bbox=dict(boxstyle='round', facecolor=self.bgcolor, pad=0.3, edgecolor='none'),
-                color='w', zorder=3, fontsize=6, transform=ax.transAxes)
-            plt.axis('off')
+            caption.set_text(cap.upper())
             output_image_path = self.output_path.format(enh=enh_str)
             os.makedirs(os.path.dirname(output_image_path), exist_ok=True)
-            plt.savefig(output_image_path, dpi=self.dpi, facecolor=self.bgcolor)
-            plt.clf()
-            plt.close()
+            fig.savefig(output_image_path, dpi=self.dpi, facecolor=self.bgcolor)
             # copy to latest dir
             latest_image_path = os.path.join(settings.MEDIA_ROOT, 'latest/sate/b{}{}.png'.format(
                 band, enh_str))
             shutil.copyfile(output_image_path, latest_image_path)
+        plt.close(fig)
+        toc = time.time()
+        logger.info('Band{:02d} stages: extract {:.2f} s, remap {:.2f} s, render {:.2f} s'.format(
+            band, extract_toc - tic, remap_toc - extract_toc, toc - remap_toc))
@@ -1,15 +1,17 @@
 import datetime
-import ftplib
 import logging
 import os
+import queue
 import shutil
+import threading
+import time
 
 from celery import shared_task
 from django.conf import settings
 
 from sate.satefile import SateFile
 from sate.sateimage import SateImage
-from tools.fastdown import FTPFastDown
+from tools.fastdown import FTPFastDown, FTPPool
 
 PTREE_ADDR = settings.PTREE_FTP
 PTREE_UID = settings.PTREE_UID
@@ -21,6 +23,15 @@ TASKS = [
     (13, (None, 'bd', 'rbtop', 'ca'))
 ]
 
+PIPELINE_DEPTH = 2 # downloaded files waiting for dispatch
+FILE_PARALLEL = len(TASKS)
+
+# Lives as long as the worker process, so logins are reused across runs
+ftp_pool = FTPPool(PTREE_ADDR, PTREE_UID, PTREE_PWD, size=FILE_PARALLEL)
+
+# Time of the newest slot handed to imaging, shared by plotter and imager processes
+LATEST_SLOT_FILE = os.path.join(settings.TMP_ROOT, 'sate', '.latest_slot')
+
 MONITOR_DIRS = [
     os.path.join(settings.MEDIA_ROOT, 'sate'),
     os.path.join(settings.TMP_ROOT, 'sate'),
@@ -37,6 +48,50 @@ R304 -- 7m30s -- 11m50s -- 12m30s / 4 -> 150
 '''
 
 
+def get_slot_time(nowtime):
+    """Return the latest rapid scan time whose data should be available."""
+    nt_m = nowtime.minute % 10
+    nt_s = nowtime.second
+    seconds = nt_m * 60 + nt_s
+    if 405 < seconds <= 525:
+        # R301
+        return nowtime.replace(minute=nowtime.minute // 10 * 10, second=0, microsecond=0)
+    elif 525 < seconds < 600 or 0 <= seconds <= 45:
+        # R302
+        time = nowtime - datetime.timedelta(seconds=90)
+        return time.replace(minute=time.minute // 10 * 10 + 2, second=30, microsecond=0)
+    elif 45 < seconds <= 150:
+        # R303
+        time = nowtime - datetime.timedelta(minutes=10)
+        return time.replace(minute=time.minute // 10 * 10 + 5, second=0, microsecond=0)
+    else:
+        # R304
+        time = nowtime - datetime.timedelta(minutes=10)
+        return time.replace(minute=time.minute // 10 * 10 + 7, second=30, microsecond=0)
+
+def get_latest_slot():
+    try:
+        with open(LATEST_SLOT_FILE) as f:
+            return datetime.datetime.strptime(f.read().strip(), '%Y-%m-%dT%H:%M:%S')
+    except (OSError, ValueError):
+        return None
+
+def set_latest_slot(slot_time):
+    latest = get_latest_slot()
+    if latest is not None and latest >= slot_time:
+        return
+    os.makedirs(os.path.dirname(LATEST_SLOT_FILE), exist_ok=True)
+    tmp_path = '{}.{}'.format(LATEST_SLOT_FILE, os.getpid())
+    with open(tmp_path, 'w') as f:
+        f.write(slot_time.isoformat())
+    os.replace(tmp_path, LATEST_SLOT_FILE)
+
+def is_stale(slot_time):
+    """A slot is stale only once a newer slot has been dispatched to imaging."""
+    latest = get_latest_slot()
+    return latest is not None and latest > slot_time
+
+
 class TaskMaster:
 
     def go(self):
@@ -44,31 +99,12 @@ class TaskMaster:
         try:
             self.ticker()
             self.prepare_tasks()
-            self.download()
-            self.export_image()
+            self.pipeline()
         except Exception as e:
             logger.exception('wtf')
 
     def ticker(self):
-        nowtime = datetime.datetime.utcnow()
-        nt_m = nowtime.minute % 10
-        nt_s = nowtime.second
-        seconds = nt_m * 60 + nt_s
-        if 405 < seconds <= 525:
-            # R301
-            self.time = nowtime.replace(minute=nowtime.minute // 10 * 10, second=0, microsecond=0)
-        elif 525 < seconds < 600 or 0 <= seconds <= 45:
-            # R302
-            time = nowtime - datetime.timedelta(seconds=90)
-            self.time = time.replace(minute=time.minute // 10 * 10 + 2, second=30, microsecond=0)
-        elif 45 < seconds <= 150:
-            # R303
-            time = nowtime - datetime.timedelta(minutes=10)
-            self.time = time.replace(minute=time.minute // 10 * 10 + 5, second=0, microsecond=0)
-        elif 150 < seconds <= 405:
-            # R304
-            time = nowtime - datetime.timedelta(minutes=10)
-            self.time = time.replace(minute=time.minute // 10 * 10 + 7, second=30, microsecond=0)
+        self.time = get_slot_time(datetime.datetime.utcnow())
         logging.debug('Ticker time: {}'.format(self.time))
 
     def prepare_tasks(self):
@@ -77,21 +113,59 @@ class TaskMaster:
             sf = SateFile(self.time, band=band, enhance=enhance)
             self.task_files.append(sf)
 
-    def download(self):
-        ftp = ftplib.FTP(PTREE_ADDR, PTREE_UID, PTREE_PWD)
-        downer = FTPFastDown(file_parallel=1)
-        downer.set_ftp(ftp)
+    def pipeline(self):
+        """Hand every band to imaging as soon as its transfer finishes, so that
+        decoding overlaps with the remaining downloads."""
+        finished = queue.Queue(maxsize=PIPELINE_DEPTH)
+        files = {sf.target_path: sf for sf in self.task_files}
+        def produce():
+            tic = time.time()
+            try:
+                self.download(callback=lambda task: finished.put(files[task.filename]))
+                logger.info('Download elapsed: {:.1f} s'.format(time.time() - tic))
+            except Exception:
+                logger.exception('Download failed')
+            finally:
+                finished.put(None)
+        producer = threading.Thread(target=produce)
+        producer.start()
+        while True:
+            sf = finished.get()
+            if sf is None:
+                break
+            self.export_image(sf)
+        producer.join()
+
+    def download(self, callback=None):
+        downer = FTPFastDown(file_parallel=FILE_PARALLEL)
+        downer.set_ftp_pool(ftp_pool)
+        downer.set_callback(callback)
         downer.set_task([(s.source_path, s.target_path) for s in self.task_files])
         downer.download()
-        ftp.close()
         logging.info('Download finished.')
 
-    def export_image(self):
-        for sf in self.task_files:
-            SateImage(sf).imager()
-            logging.debug('Band{:02d} image exported.'.format(sf.band))
-        logging.info('All images exported.')
+    def export_image(self, sf):
+        """Send a band to the worker pool. Waiting tasks of older slots are
+        dropped by the imager once this slot is dispatched."""
+        if is_stale(self.time):
+            logger.warning('Slot {} is stale, skipped.'.format(self.time))
+            return
+        set_latest_slot(self.time)
+        imager.delay(self.time.isoformat(), sf.band, sf.enhance)
+        logging.debug('Band{:02d} image dispatched.'.format(sf.band))
+
 
+@shared_task
+def imager(slot_time, band, enhance):
+    slot_time = datetime.datetime.strptime(slot_time, '%Y-%m-%dT%H:%M:%S')
+    if is_stale(slot_time):
+        logger.warning('Band{:02d} of slot {} is stale, dropped.'.format(band, slot_time))
+        return
+    if isinstance(enhance, list):
+        enhance = tuple(enhance)
+    tic = time.time()
+    SateImage(SateFile(slot_time, band=band, enhance=enhance)).imager()
+    logger.info('Band{:02d} image exported in {:.1f} s.'.format(band, time.time() - tic))
 
 @shared_task
 def plotter():
@@ -1,9 +1,30 @@
+import bz2
 import ftplib
+import queue
 import re
 import os
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
 
 import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 1 << 20
+BLOCK_SIZE = 8192
+STREAM_SIZE = 1 << 16 # bytes held in memory per streaming download
+PART_SUFFIX = '.part'
+CHUNK_SUFFIX = '.chunks' # preallocated, so it must not be resumed like a .part file
+
+
+def bz2_stream(blocks):
+    """Decompress an iterable of bz2 blocks on the fly."""
+    decompressor = bz2.BZ2Decompressor()
+    for block in blocks:
+        data = decompressor.decompress(block)
+        if data:
+            yield data
 
 
 class AtomTask:
@@ -14,9 +35,10 @@ class AtomTask:
         self.chunk_size = chunk_size
         self.offset = offset
         self.tries = 0
+        self.received = 0 # bytes already handed to a process hook
 
     def __str__(self):
-        return self.filename
+        return self.filename or self.url
 
 
 class BaseDownloader:
@@ -29,6 +51,9 @@ class BaseDownloader:
         self.executor = None
         self.basedir = ''
         self.process_hook = None
+        self.callback = None
+        self.progress = {}
+        self._progress_lock = threading.Lock()
 
     def set_executor(self, executor):
         self.executor = executor
@@ -37,10 +62,87 @@ class BaseDownloader:
         self.basedir = basedir
 
     def set_process_hook(self, func):
+        """`func` receives an iterator over blocks of the body instead of
+        having it written to disk, e.g. `lambda blocks: sink(bz2_stream(blocks))`.
+        A transfer broken after the hook got data is not retried, since the hook
+        cannot be fed the same bytes twice."""
         self.process_hook = func
 
+    def hook_stream(self, task, blocks):
+        for block in blocks:
+            task.received += len(block)
+            yield block
+
+    def failed_hook(self, task):
+        if task.received:
+            raise IOError('Stream of {} broken after {} bytes, cannot restart the process '
+                'hook'.format(task, task.received))
+        return self.failed(task)
+
+    @contextmanager
+    def partial(self, task):
+        """Yield the path of a partial file, which is renamed onto the target
+        once the block exits cleanly and kept for resuming otherwise."""
+        path = os.path.join(self.basedir, task.filename)
+        yield path + PART_SUFFIX
+        os.replace(path + PART_SUFFIX, path)
+
+    def resume_offset(self, path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def set_callback(self, func):
+        """`func` is called with the task once its file is downloaded."""
+        self.callback = func
+
+    def succeeded(self, task):
+        print('Succeed: {}'.format(task))
+        if self.callback:
+            self.callback(task)
+
     def __call__(self, task):
-        pass
+        if task.chunk_size is None:
+            return self.single(task)
+        else:
+            return self.chunk(task)
+
+    def get_size(self, url):
+        """Return size of remote file if it can be fetched by ranges, else None."""
+        return None
+
+    def expect(self, filename, size):
+        """Preallocate a chunked file of `size` bytes. Chunks are written into
+        <filename>.chunks, which is renamed onto the target once complete."""
+        with open(os.path.join(self.basedir, filename + CHUNK_SUFFIX), 'wb') as f:
+            f.truncate(size)
+        self.progress[filename] = [size, 0]
+
+    def write_chunk(self, task, data):
+        if len(data) != task.chunk_size:
+            raise IOError('Chunk length mismatch: {} at {}, {}/{} bytes'.format(task,
+                task.offset, len(data), task.chunk_size))
+        path = os.path.join(self.basedir, task.filename)
+        fd = os.open(path + CHUNK_SUFFIX, os.O_WRONLY)
+        try:
+            os.pwrite(fd, data, task.offset)
+        finally:
+            os.close(fd)
+        with self._progress_lock:
+            entry = self.progress[task.filename]
+            entry[1] += len(data)
+            finished = entry[1] == entry[0]
+        if finished:
+            os.replace(path + CHUNK_SUFFIX, path)
+            self.succeeded(task)
+
+    def verify(self):
+        """Check that every chunked file has been completely reassembled."""
+        for filename, (size, written) in self.progress.items():
+            path = os.path.join(self.basedir, filename)
+            if written != size or not os.path.exists(path) or os.path.getsize(path) != size:
+                raise IOError('Incomplete download: {} {}/{} bytes'.format(filename, written, size))
 
     def failed(self, task):
         print('Failed: {}'.format(task))
@@ -53,11 +155,34 @@ class BaseDownloader:
 
 class RequestsDownloader(BaseDownloader):
 
-    def __call__(self, task):
-        if task.chunk_size is None:
-            return self.single(task)
-        else:
-            raise NotImplementedError('Chunk download feature hasn\'t been implemented, please be patient!')
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=max(self.chunk_parallel, 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_size(self, url):
+        try:
+            res = self.session.head(url, allow_redirects=True, timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            return None
+        length = res.headers.get('content-length')
+        if res.headers.get('accept-ranges') != 'bytes' or not length:
+            return None
+        return int(length)
+
+    def chunk(self, task):
+        headers = {'Range': 'bytes={}-{}'.format(task.offset, task.offset + task.chunk_size - 1)}
+        try:
+            res = self.session.get(task.url, headers=headers, allow_redirects=True,
+                timeout=self.timeout)
+            if res.status_code != 206:
+                raise IOError('Range not satisfied: {}'.format(res.status_code))
+            self.write_chunk(task, res.content)
+        except (requests.exceptions.RequestException, IOError) as err:
+            print('Download error', err)
+            return self.failed(task)
 
     def get_filename_from_header(self, header):
         disposition = header.get('content-disposition')
@@ -69,17 +194,56 @@ class RequestsDownloader(BaseDownloader):
         return filenames[0]
 
     def single(self, task):
+        if self.process_hook:
+            try:
+                with self.session.get(task.url, allow_redirects=True, timeout=self.timeout,
+                        stream=True) as res:
+                    res.raise_for_status()
+                    self.process_hook(self.hook_stream(task, res.iter_content(STREAM_SIZE)))
+            except (requests.exceptions.RequestException, IOError) as err:
+                print('Download error', err)
+                return self.failed_hook(task)
+            return self.succeeded(task)
         try:
-            res = requests.get(task.url, allow_redirects=True, timeout=self.timeout)
-        except (requests.exceptions.Timeout, requests.exceptions.RequestException):
+            self.stream(task)
+        except (requests.exceptions.RequestException, IOError) as err:
+            print('Download error', err)
             return self.failed(task)
+        self.succeeded(task)
+
+    def stream(self, task):
         if task.filename is None:
+            res = self.session.head(task.url, allow_redirects=True, timeout=self.timeout)
             task.filename = self.get_filename_from_header(res.headers)
-        if self.process_hook:
-            self.process_hook(res.content)
-        else:
-            open(os.path.join(self.basedir, task.filename), 'wb').write(res.content)
-        print('Succeed: {}'.format(task))
+        with self.partial(task) as part:
+            offset = self.resume_offset(part)
+            headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+            with self.session.get(task.url, headers=headers, allow_redirects=True,
+                    timeout=self.timeout, stream=True) as res:
+                if res.status_code == 416:
+                    # Partial file is stale or already larger than the remote one
+                    os.remove(part)
+                    raise IOError('Cannot resume {} from {}'.format(task, offset))
+                res.raise_for_status()
+                if res.status_code != 206:
+                    offset = 0
+                size = self.get_total_size(res.headers, offset)
+                with open(part, 'ab' if offset else 'wb') as f:
+                    for block in res.iter_content(STREAM_SIZE):
+                        f.write(block)
+            if size is not None and os.path.getsize(part) != size:
+                raise IOError('Incomplete download: {} {}/{} bytes'.format(task,
+                    os.path.getsize(part), size))
+
+    def get_total_size(self, header, offset):
+        content_range = header.get('content-range')
+        if content_range and '/' in content_range:
+            total = content_range.rsplit('/', 1)[1]
+            return int(total) if total.isdigit() else None
+        length = header.get('content-length')
+        if length and 'content-encoding' not in header:
+            return offset + int(length)
+        return None
 
 
 class FastDown:
@@ -91,18 +255,27 @@ class FastDown:
         self.chunk_parallel = chunk_parallel
         self.chunk_size = chunk_size
         if self.chunk_size is None and self.chunk_parallel > 1:
-            self.chunk_size = 8192
+            self.chunk_size = CHUNK_SIZE
         self.retry = retry
         self.timeout = timeout
         self.service = self.default_service
         self.basedir = ''
+        self.process_hook = None
+        self.callback = None
 
     def use_downloader(self, service):
         self.service = service
 
+    def set_callback(self, func):
+        self.callback = func
+
     def set_basedir(self, basedir):
         self.basedir = basedir
 
+    def set_process_hook(self, func):
+        """Stream bodies into `func`, see BaseDownloader.set_process_hook."""
+        self.process_hook = func
+
     def set_task(self, task):
         """Task should be arranged like list of (url, filename) tuples."""
         self.targets = []
@@ -121,101 +294,254 @@ class FastDown:
             except TypeError:
                 raise ValueError('task must be length-2 tuple or iterable of length-2 tuples.')
 
-    def create_atom_task(self, url, filename):
-        if self.chunk_parallel == 1:
+    def create_atom_task(self, url, filename, size=None):
+        if size is None or self.chunk_size is None:
             return [AtomTask(url, filename)]
-        return [AtomTask(url, filename, self.chunk_size, self.chunk_size * i)
-                for i in range(self.chunk_parallel)]
-
-    def download(self):
+        return [AtomTask(url, filename, min(self.chunk_size, size - offset), offset)
+                for offset in range(0, size, self.chunk_size)]
+
+    def split_task(self, downloader, task):
+        """Split a task into ranged chunks written in place into a preallocated
+        file. Falls back to a single download if the size is unknown."""
+        if task.filename is None or downloader.process_hook:
+            return [task]
+        size = downloader.get_size(task.url)
+        if size is None or size <= self.chunk_size:
+            return [task]
+        downloader.expect(task.filename, size)
+        return self.create_atom_task(task.url, task.filename, size)
+
+    def create_downloader(self):
         downloader = self.service(self.chunk_parallel, self.chunk_size, self.retry, self.timeout)
         downloader.set_basedir(self.basedir)
-        with ThreadPoolExecutor(max_workers=self.file_parallel) as executor:
+        downloader.set_process_hook(self.process_hook)
+        downloader.set_callback(self.callback)
+        return downloader
+
+    def download(self):
+        downloader = self.create_downloader()
+        targets, self.targets = self.targets, []
+        if self.chunk_size is not None:
+            targets = [atom for task in targets for atom in self.split_task(downloader, task)]
+        with ThreadPoolExecutor(max_workers=self.file_parallel * self.chunk_parallel) as executor:
             downloader.set_executor(executor)
-            futures = executor.map(downloader, self.targets)
-            self.targets = []
+            futures = executor.map(downloader, targets)
             for future in futures:
                 while isinstance(future, Future):
                     future = future.result()
+        downloader.verify()
+
+
+class FTPPool:
+    """Authenticated FTP connections, one per worker thread, kept alive across
+    downloads. Idle connections are checked with NOOP and replaced if dead."""
+
+    def __init__(self, host, user, passwd, size=4, timeout=30, keepalive=60, port=21):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(self.user, self.passwd)
+        return ftp
+
+    def acquire(self):
+        self.slots.acquire()
+        try:
+            while True:
+                try:
+                    ftp, last_used = self.idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                if time.time() - last_used < self.keepalive:
+                    return ftp
+                try:
+                    ftp.voidcmd('NOOP')
+                    return ftp
+                except ftplib.all_errors:
+                    self.discard(ftp)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def release(self, ftp, broken=False):
+        if broken:
+            self.discard(ftp)
+        else:
+            self.idle.put((ftp, time.time()))
+        self.slots.release()
+
+    def discard(self, ftp):
+        try:
+            ftp.close()
+        except ftplib.all_errors:
+            pass
+
+    @contextmanager
+    def connection(self):
+        ftp = self.acquire()
+        try:
+            yield ftp
+        except Exception:
+            self.release(ftp, broken=True)
+            raise
+        else:
+            self.release(ftp)
+
+    def close(self):
+        while True:
+            try:
+                ftp, last_used = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                self.discard(ftp)
 
 
 class FTPDownloader(BaseDownloader):
     
-    def __call__(self, task):
-        if task.chunk_size is None:
-            return self.single(task)
-        else:
-            raise NotImplementedError('Chunk download feature hasn\'t been implemented, please be patient!')
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ftp = None
+        self.pool = None
 
     def set_ftp_handler(self, ftp):
         self.ftp = ftp
 
+    def set_ftp_pool(self, pool):
+        self.pool = pool
+
+    @contextmanager
+    def connection(self):
+        if self.pool is None:
+            yield self.ftp
+        else:
+            with self.pool.connection() as ftp:
+                yield ftp
+
+    def iter_retr(self, ftp, path):
+        ftp.voidcmd('TYPE I')
+        conn = ftp.transfercmd('RETR {}'.format(path))
+        try:
+            while True:
+                block = conn.recv(STREAM_SIZE)
+                if not block:
+                    break
+                yield block
+        finally:
+            conn.close()
+        ftp.voidresp()
+
+    def single_hook(self, task):
+        try:
+            with self.connection() as ftp:
+                blocks = self.hook_stream(task, self.iter_retr(ftp, task.url))
+                self.process_hook(blocks)
+                # Drain whatever the hook left, so the transfer reply is read
+                for block in blocks:
+                    pass
+        except Exception as err:
+            print('Download error', err)
+            if self.pool is not None:
+                return self.failed_hook(task)
+            raise
+        self.succeeded(task)
+
     def single(self, task):
+        if self.process_hook:
+            return self.single_hook(task)
         try:
-            self.ftp.retrbinary(
-                'RETR {}'.format(task.url),
-                open(os.path.join(self.basedir, task.filename), 'wb').write
-            )
+            with self.connection() as ftp, self.partial(task) as part:
+                offset = self.resume_offset(part)
+                with open(part, 'ab' if offset else 'wb') as f:
+                    ftp.retrbinary('RETR {}'.format(task.url), f.write, blocksize=STREAM_SIZE,
+                        rest=offset or None)
         except Exception as err:
             print('Download error', err)
+            if self.pool is not None:
+                # Connection was dropped from the pool, retry with a fresh one
+                return self.failed(task)
+        else:
+            self.succeeded(task)
 
+    def get_size(self, url):
+        try:
+            with self.connection() as ftp:
+                ftp.voidcmd('TYPE I')
+                return ftp.size(url)
+        except ftplib.all_errors:
+            return None
+
+    def retr_range(self, ftp, path, offset, length, at_end):
+        """RETR from `offset` via REST and read `length` bytes. Return the data
+        and whether the control connection is still in a known state: a
+        transfer stopped before the end of file leaves replies pending."""
+        ftp.voidcmd('TYPE I')
+        conn = ftp.transfercmd('RETR {}'.format(path), rest=offset)
+        buf = bytearray()
+        try:
+            while len(buf) < length:
+                block = conn.recv(min(BLOCK_SIZE, length - len(buf)))
+                if not block:
+                    break
+                buf.extend(block)
+            if at_end:
+                while conn.recv(BLOCK_SIZE):
+                    pass
+        finally:
+            conn.close()
+        if not at_end:
+            return bytes(buf), False
+        ftp.voidresp()
+        return bytes(buf), True
+
+    def chunk(self, task):
+        if self.pool is None:
+            raise ValueError('Chunked FTP downloads need a connection pool.')
+        try:
+            at_end = task.offset + task.chunk_size == self.progress[task.filename][0]
+            ftp = self.pool.acquire()
+            reusable = False
+            try:
+                data, reusable = self.retr_range(ftp, task.url, task.offset, task.chunk_size,
+                    at_end)
+            finally:
+                self.pool.release(ftp, broken=not reusable)
+            self.write_chunk(task, data)
+        except Exception as err:
+            print('Download error', err)
+            return self.failed(task)
 
-class FTPFastDown:
 
-    default_service = FTPDownloader
+class FTPFastDown(FastDown):
 
-    def __init__(self, file_parallel=1, chunk_parallel=1, chunk_size=None, retry=5, timeout=3):
-        self.file_parallel = file_parallel
-        self.chunk_parallel = chunk_parallel
-        self.chunk_size = chunk_size
-        if self.chunk_size is None and self.chunk_parallel > 1:
-            self.chunk_size = 8192
-        self.retry = retry
-        self.timeout = timeout
-        self.service = self.default_service
-        self.basedir = ''
+    default_service = FTPDownloader
 
-    def use_downloader(self, service):
-        self.service = service
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ftp = None
+        self.ftp_pool = None
 
     def set_ftp(self, ftp):
+        """Share one connection among workers, only safe with file_parallel=1."""
         self.ftp = ftp
 
-    def set_basedir(self, basedir):
-        self.basedir = basedir
-
-    def set_task(self, task):
-        """Task should be arranged like list of (url, filename) tuples."""
-        self.targets = []
-        if isinstance(task, tuple):
-            self.targets.extend(self.create_atom_task(*task))
-        elif isinstance(task, str):
-            self.targets.extend(self.create_atom_task(task, None))
-        else:
-            try:
-                for t in task:
-                    if isinstance(t, tuple):
-                        url, filename = t
-                    else:
-                        url, filename = t, None
-                    self.targets.extend(self.create_atom_task(url, filename))
-            except TypeError:
-                raise ValueError('task must be length-2 tuple or iterable of length-2 tuples.')
-
-    def create_atom_task(self, url, filename):
-        if self.chunk_parallel == 1:
-            return [AtomTask(url, filename)]
-        return [AtomTask(url, filename, self.chunk_size, self.chunk_size * i)
-                for i in range(self.chunk_parallel)]
+    def set_ftp_pool(self, pool):
+        self.ftp_pool = pool
 
-    def download(self):
-        downloader = self.service(self.chunk_parallel, self.chunk_size, self.retry, self.timeout)
-        downloader.set_basedir(self.basedir)
+    def create_downloader(self):
+        if self.chunk_size is not None and self.ftp_pool is None:
+            raise ValueError('Chunked FTP downloads need a connection pool, see set_ftp_pool.')
+        downloader = super().create_downloader()
         downloader.set_ftp_handler(self.ftp)
-        with ThreadPoolExecutor(max_workers=self.file_parallel) as executor:
-            downloader.set_executor(executor)
-            futures = executor.map(downloader, self.targets)
-            self.targets = []
-            for future in futures:
-                while isinstance(future, Future):
-                    future = future.result()
+        downloader.set_ftp_pool(self.ftp_pool)
+        return downloader
@@ -0,0 +1,70 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlightTimeout(Exception):
+    pass
+
+
+class SingleFlight:
+    """Make sure only one worker (process or thread) produces a target file at a
+    time. Other workers asking for the same key block on a lock file and reuse
+    the result once the leader finishes."""
+
+    def __init__(self, timeout=30, interval=0.05):
+        self.timeout = timeout
+        self.interval = interval
+        self.stats = {'hit': 0, 'leader': 0, 'coalesced': 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _acquire(self, lockfile):
+        """Return True if we had to wait for another worker."""
+        waited = False
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return waited
+            except BlockingIOError:
+                waited = True
+                if time.time() > deadline:
+                    raise SingleFlightTimeout('Lock wait timeout: {}'.format(lockfile.name))
+                time.sleep(self.interval)
+
+    def do(self, lockpath, target, func):
+        """Call `func` to produce `target` unless it exists or another worker
+        holding `lockpath` has produced it meanwhile. Return True if `func`
+        was called by this worker."""
+        if os.path.exists(target):
+            self._count('hit')
+            return False
+        with open(lockpath, 'a') as lockfile:
+            waited = self._acquire(lockfile)
+            try:
+                if os.path.exists(target):
+                    self._count('coalesced' if waited else 'hit')
+                    if waited:
+                        logger.info('Coalesced: {} {}'.format(target, self.report()))
+                    return False
+                func()
+                self._count('leader')
+                return True
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def report(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        total = sum(stats.values())
+        ratio = stats['coalesced'] / total if total else 0
+        return 'hit={hit} leader={leader} coalesced={coalesced}'.format(**stats) + \
+            ' ({:.1%} coalesced)'.format(ratio)
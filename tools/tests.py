@@ -0,0 +1,142 @@
+import bz2
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from django.test import SimpleTestCase
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import ThreadedFTPServer
+
+from tools.fastdown import CHUNK_SUFFIX, PART_SUFFIX, FTPFastDown, FTPPool, bz2_stream
+
+USER = 'user'
+PASSWD = 'passwd'
+POOL_SIZE = 4
+CHUNK = 1 << 16 # bytes, small enough to keep the transfers quick
+
+logging.getLogger('pyftpdlib').setLevel(logging.WARNING)
+
+
+class StubHandler(FTPHandler):
+
+    def on_login(self, username):
+        with self.server.lock:
+            self.server.logins += 1
+
+    def ftp_REST(self, line):
+        with self.server.lock:
+            self.server.rests.append(int(line))
+        return super().ftp_REST(line)
+
+
+class StubFTPServer(ThreadedFTPServer):
+    """Local FTP server serving `root`, counting logins and REST offsets."""
+
+    def __init__(self, root):
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(USER, PASSWD, root, perm='elr')
+        handler = type('Handler', (StubHandler,), {'authorizer': authorizer})
+        super().__init__(('127.0.0.1', 0), handler)
+        self.logins = 0
+        self.rests = []
+        self.lock = threading.Lock()
+
+
+class FTPDownloadTests(SimpleTestCase):
+
+    def setUp(self):
+        self.remote = tempfile.mkdtemp()
+        self.local = tempfile.mkdtemp()
+        self.server = StubFTPServer(self.remote)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        port = self.server.socket.getsockname()[1]
+        self.pool = FTPPool('127.0.0.1', USER, PASSWD, size=POOL_SIZE, timeout=5, port=port)
+
+    def serve(self):
+        while not self.stopped.is_set():
+            self.server.serve_forever(timeout=0.05, blocking=False, handle_exit=False)
+
+    def tearDown(self):
+        self.pool.close()
+        self.stopped.set()
+        self.thread.join()
+        self.server.close_all()
+        shutil.rmtree(self.remote)
+        shutil.rmtree(self.local)
+
+    def put(self, filename, size, compress=False):
+        data = os.urandom(size)
+        with open(os.path.join(self.remote, filename), 'wb') as f:
+            f.write(bz2.compress(data) if compress else data)
+        return data
+
+    def read(self, filename):
+        with open(os.path.join(self.local, filename), 'rb') as f:
+            return f.read()
+
+    def download(self, filenames, hook=None, **kwargs):
+        fastdown = FTPFastDown(retry=2, timeout=5, **kwargs)
+        fastdown.set_ftp_pool(self.pool)
+        fastdown.set_process_hook(hook)
+        fastdown.set_basedir(self.local)
+        fastdown.set_task([(filename, filename) for filename in filenames])
+        fastdown.download()
+
+    def test_connection_reused(self):
+        first = self.put('first.bin', CHUNK)
+        second = self.put('second.bin', CHUNK)
+        self.download(['first.bin', 'second.bin'])
+        self.assertEqual(self.read('first.bin'), first)
+        self.assertEqual(self.read('second.bin'), second)
+        self.assertEqual(self.server.logins, 1)
+
+    def test_broken_connection_replaced(self):
+        data = self.put('band.bin', CHUNK)
+        self.pool.keepalive = 0 # check idle connections before every use
+        ftp = self.pool.acquire()
+        self.pool.release(ftp)
+        ftp.sock.shutdown(socket.SHUT_RDWR)
+        self.download(['band.bin'])
+        self.assertEqual(self.read('band.bin'), data)
+        self.assertEqual(self.server.logins, 2)
+        self.assertIsNot(self.pool.idle.get_nowait()[0], ftp)
+
+    def test_resume_part(self):
+        data = self.put('band.bin', 3 * CHUNK)
+        with open(os.path.join(self.local, 'band.bin' + PART_SUFFIX), 'wb') as f:
+            f.write(data[:CHUNK])
+        self.download(['band.bin'])
+        self.assertEqual(self.read('band.bin'), data)
+        self.assertEqual(self.server.rests, [CHUNK])
+        self.assertFalse(os.path.exists(os.path.join(self.local, 'band.bin' + PART_SUFFIX)))
+
+    def test_chunk_reassembly(self):
+        data = self.put('band.bin', 3 * CHUNK + 1234)
+        self.download(['band.bin'], chunk_parallel=POOL_SIZE, chunk_size=CHUNK)
+        self.assertEqual(self.read('band.bin'), data)
+        self.assertEqual(sorted(self.server.rests), [0, CHUNK, 2 * CHUNK, 3 * CHUNK])
+        self.assertFalse(os.path.exists(os.path.join(self.local, 'band.bin' + CHUNK_SUFFIX)))
+
+    def test_pool_full_after_chunks(self):
+        self.put('first.bin', 4 * CHUNK)
+        self.put('second.bin', 2 * CHUNK + 1)
+        self.download(['first.bin', 'second.bin'], file_parallel=2, chunk_parallel=2,
+            chunk_size=CHUNK)
+        acquired = [self.pool.slots.acquire(blocking=False) for i in range(POOL_SIZE + 1)]
+        self.assertEqual(acquired, [True] * POOL_SIZE + [False])
+        for i in range(POOL_SIZE):
+            self.pool.slots.release()
+
+    def test_process_hook_bz2(self):
+        data = self.put('band.bin.bz2', 3 * CHUNK, compress=True)
+        received = []
+        self.download(['band.bin.bz2'], hook=lambda blocks: received.extend(bz2_stream(blocks)),
+            chunk_parallel=POOL_SIZE, chunk_size=CHUNK)
+        self.assertEqual(b''.join(received), data)
+        self.assertFalse(os.path.exists(os.path.join(self.local, 'band.bin.bz2')))
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+# Point this to a local stub server in tests, e.g. 'http://127.0.0.1:8765'
+WINDY_HOST = getattr(settings, 'WINDY_HOST', 'https://node.windy.com')
+DETAIL_ADDR = '{host}/forecast/v2.1/ecmwf/{lat:.3f}/{lon:.3f}?source=detail'
+METEO_ADDR = '{host}/forecast/meteogram/ecmwf/{lat:.3f}/{lon:.3f}'
+GRID_RESOLUTION = 0.125 # ECMWF HRES 13km, in degrees
+CACHE_SIZE = getattr(settings, 'FORECAST_CACHE_SIZE', 256) # in entries per run
+CACHE_TTL = getattr(settings, 'FORECAST_CACHE_TTL', 12 * 3600) # in seconds
+CACHE_RUNS = 2 # newest model runs kept, older run folders are removed
+CACHE_DIR = os.path.join(settings.TMP_ROOT, 'forecast')
+
+
+class ForecastClient:
+    """Fetch detail and meteogram payloads of a point concurrently over a
+    keep-alive connection pool shared by the whole worker process."""
+
+    def __init__(self, host=WINDY_HOST, timeout=0.5, retry=2, pool_size=8):
+        self.host = host
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+            max_retries=Retry(total=retry, backoff_factor=0.1,
+            status_forcelist=(500, 502, 503, 504)))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+    def _record(self, kind, elapsed):
+        with self._stats_lock:
+            count, total, peak = self.stats.get(kind, (0, 0., 0.))
+            self.stats[kind] = (count + 1, total + elapsed, max(peak, elapsed))
+
+    def get_json(self, kind, url):
+        tic = time.time()
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        elapsed = time.time() - tic
+        self._record(kind, elapsed)
+        logger.debug('Request: {}'.format(url))
+        logger.debug('Elapsed: {:.0f} ms'.format(elapsed * 1e3))
+        return data
+
+    def fetch(self, lat, lon):
+        """Return (detail_data, meteo_data) of the point."""
+        detail_url = DETAIL_ADDR.format(host=self.host, lat=lat, lon=lon)
+        meteo_url = METEO_ADDR.format(host=self.host, lat=lat, lon=lon)
+        detail = self.executor.submit(self.get_json, 'detail', detail_url)
+        meteo = self.executor.submit(self.get_json, 'meteo', meteo_url)
+        return detail.result(), meteo.result()
+
+    def report(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        return ' '.join('{}: n={} avg={:.0f}ms max={:.0f}ms'.format(kind, count,
+            total / count * 1e3, peak * 1e3) for kind, (count, total, peak) in stats.items())
+
+
+class ForecastCache:
+    """Cache of forecast payloads keyed by model run and the grid point nearest
+    to the query, so that neighbouring points share one fetch. Payloads are
+    JSON files in one folder per run under `root`, shared by every worker
+    process. File mtime tracks the last use, so the least recently used are
+    evicted beyond `maxsize` entries per run; only the newest `runs` folders
+    are kept."""
+
+    def __init__(self, client, maxsize=CACHE_SIZE, ttl=CACHE_TTL, resolution=GRID_RESOLUTION,
+            root=CACHE_DIR, runs=CACHE_RUNS):
+        self.client = client
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.resolution = resolution
+        self.root = root
+        self.runs = runs
+        self.stats = {'hit': 0, 'miss': 0, 'expired': 0, 'evicted': 0}
+        self._lock = threading.Lock()
+
+    def snap(self, lat, lon):
+        res = self.resolution
+        return round(round(lat / res) * res, 3), round(round(lon / res) * res, 3)
+
+    def cache_dir(self, run):
+        return os.path.join(self.root, run.strftime('%Y%m%d%H'))
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _get(self, path):
+        try:
+            with open(path) as f:
+                stored_time, detail, meteo = json.load(f)
+        except (OSError, ValueError):
+            self._count('miss')
+            return None
+        if time.time() - stored_time > self.ttl:
+            self._count('expired')
+            self._count('miss')
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass # evicted meanwhile, the payload is still good
+        self._count('hit')
+        return detail, meteo
+
+    def _set(self, path, data):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+            self._prune_runs(os.path.basename(directory))
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump([time.time()] + list(data), f)
+        os.replace(tmp_path, path)
+        self._evict(directory)
+
+    def _prune_runs(self, current):
+        """Remove run folders older than the newest `runs`, except `current`."""
+        runs = sorted(folder for folder in os.listdir(self.root) if folder.isdigit())
+        for folder in runs[:max(len(runs) - self.runs, 0)]:
+            if folder != current:
+                shutil.rmtree(os.path.join(self.root, folder), ignore_errors=True)
+
+    def _evict(self, directory):
+        entries = []
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                entries.append((os.path.getmtime(os.path.join(directory, filename)), filename))
+            except OSError:
+                pass
+        entries.sort()
+        for stored_time, filename in entries[:max(len(entries) - self.maxsize, 0)]:
+            try:
+                os.remove(os.path.join(directory, filename))
+                self._count('evicted')
+            except OSError:
+                pass
+
+    def fetch(self, run, lat, lon):
+        """Return (detail_data, meteo_data) of the grid point nearest to (lat, lon)
+        in model run `run`."""
+        grid_lat, grid_lon = self.snap(lat, lon)
+        path = os.path.join(self.cache_dir(run),
+            '{:.3f}_{:.3f}.json'.format(grid_lat, grid_lon))
+        data = self._get(path)
+        if data is None:
+            data = self.client.fetch(grid_lat, grid_lon)
+            self._set(path, data)
+        return data
+
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+        total = stats['hit'] + stats['miss']
+        ratio = stats['hit'] / total if total else 0
+        return 'hit={hit} miss={miss} expired={expired} evicted={evicted}'.format(
+            **stats) + ' ({:.1%} hit)'.format(ratio)
+
+
+forecast_client = ForecastClient()
+forecast_cache = ForecastCache(forecast_client)
@@ -0,0 +1,108 @@
+import atexit
+import datetime
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+
+from viewer.models import HitRecord, Station
+
+# Hits buffered in a crashed process are lost, so the interval is also the loss window
+FLUSH_INTERVAL = getattr(settings, 'HIT_FLUSH_INTERVAL', 30) # in seconds
+FLUSH_SIZE = getattr(settings, 'HIT_FLUSH_SIZE', 200) # pending hits forcing a flush
+
+logger = logging.getLogger(__name__)
+
+
+class HitCounter:
+    """Aggregate plot hits in memory and write them behind with atomic F()
+    increments, instead of read-modify-write saves on every request."""
+
+    def __init__(self, interval=FLUSH_INTERVAL, size=FLUSH_SIZE):
+        self.interval = interval
+        self.size = size
+        self.stations = Counter()
+        self.records = Counter()
+        self.pending = 0
+        self.last_flush = time.time()
+        self.stats = {'hits': 0, 'flushes': 0, 'flushed': 0, 'flush_time': 0.}
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def _ensure_timer(self):
+        # Started lazily, so that each forked web worker gets its own thread
+        if self._timer is None or not self._timer.is_alive():
+            self._timer = threading.Thread(target=self._run_timer, daemon=True)
+            self._timer.start()
+
+    def _run_timer(self):
+        while True:
+            time.sleep(self.interval)
+            close_old_connections()
+            self.flush()
+
+    def hit(self, station_code, record_name):
+        """Count one hit. `station_code` is None for plain coordinates."""
+        with self._lock:
+            if station_code is not None:
+                self.stations[station_code] += 1
+            self.records[(record_name, datetime.date.today())] += 1
+            self.pending += 1
+            self.stats['hits'] += 1
+            due = self.pending >= self.size or time.time() - self.last_flush > self.interval
+            self._ensure_timer()
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            stations, self.stations = self.stations, Counter()
+            records, self.records = self.records, Counter()
+            pending, self.pending = self.pending, 0
+            self.last_flush = time.time()
+        if not pending:
+            return
+        tic = time.time()
+        try:
+            with transaction.atomic():
+                for code, count in stations.items():
+                    Station.objects.filter(code=code).update(hit=F('hit') + count)
+                for (name, date), count in records.items():
+                    self._flush_record(name, date, count)
+        except Exception:
+            logger.exception('Hit flush failed, {} hits dropped'.format(pending))
+            return
+        elapsed = time.time() - tic
+        with self._lock:
+            self.stats['flushes'] += 1
+            self.stats['flushed'] += pending
+            self.stats['flush_time'] += elapsed
+        logger.debug('Flushed {} hits in {:.0f} ms'.format(pending, elapsed * 1e3))
+        logger.info('Hit counter: {}'.format(self.report()))
+
+    def _flush_record(self, name, date, count):
+        qs = HitRecord.objects.filter(name=name, date=date)
+        if qs.update(hit=F('hit') + count):
+            return
+        try:
+            with transaction.atomic():
+                HitRecord.objects.create(name=name, date=date, hit=count)
+        except IntegrityError:
+            # Another process created it meanwhile
+            qs.update(hit=F('hit') + count)
+
+    def report(self):
+        with self._lock:
+            stats = dict(self.stats)
+            pending = self.pending
+        avg = stats['flush_time'] / stats['flushes'] * 1e3 if stats['flushes'] else 0
+        return 'hits={hits} flushed={flushed} flushes={flushes}'.format(**stats) + \
+            ' pending={} avg_flush={:.0f}ms'.format(pending, avg)
+
+
+hit_counter = HitCounter()
+atexit.register(hit_counter.flush)
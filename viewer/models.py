@@ -1,3 +1,5 @@
+import datetime
+
 from django.db import models
 
 # Create your models here.
@@ -23,7 +25,8 @@ class Station(models.Model):
 class HitRecord(models.Model):
 
     name = models.CharField(max_length=32)
-    date = models.DateField(auto_now_add=True)
+    # Not auto_now_add, buffered hits are written with the day they happened
+    date = models.DateField(default=datetime.date.today)
     hit = models.IntegerField(editable=False, default=1, blank=True)
 
     def __str__(self):
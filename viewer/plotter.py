@@ -0,0 +1,94 @@
+import datetime
+import logging
+import os
+import time
+
+from django.conf import settings
+
+from tools.singleflight import SingleFlight
+from viewer.forecast import forecast_cache, forecast_client
+from viewer.windygram.windygram import PlotTemplate, Windygram
+
+logger = logging.getLogger(__name__)
+
+TIME_00Z = datetime.time(9, 0) # BJT 17:00
+TIME_12Z = datetime.time(21, 0) # BJT 05:00
+PLOT_LOCK_TIMEOUT = 30 # in seconds
+FAILED_SUFFIX = '.failed' # marker written next to a plot whose render failed
+
+plot_flight = SingleFlight(timeout=PLOT_LOCK_TIMEOUT)
+plot_template = PlotTemplate()
+
+def get_nearest_run():
+    now = datetime.datetime.utcnow()
+    nowtime = now.time()
+    if TIME_00Z <= nowtime <= TIME_12Z:
+        return now.replace(hour=0, minute=0, second=0, microsecond=0)
+    runtime = now.replace(hour=12, minute=0, second=0, microsecond=0)
+    if nowtime < TIME_00Z:
+        runtime = runtime - datetime.timedelta(days=1)
+    return runtime
+
+def get_windygram_path(lat, lon):
+    """Return path of the plot relative to MEDIA_ROOT for current run."""
+    runtime = get_nearest_run()
+    folder_name = runtime.strftime('%Y%m%d%H')
+    short_filename = '{:.3f}-{:.3f}'.format(lat, lon)
+    short_filename = short_filename.replace('.', '_') + '.png'
+    return '{}/{}'.format(folder_name, short_filename)
+
+def get_failed_marker(filepath):
+    """Absolute path of the failure marker of a plot path relative to MEDIA_ROOT."""
+    return os.path.join(settings.MEDIA_ROOT, filepath + FAILED_SUFFIX)
+
+def get_windygram_plot(lat, lon, name):
+    filepath = get_windygram_path(lat, lon)
+    folder_name, short_filename = filepath.split('/')
+    directory = os.path.join(settings.MEDIA_ROOT, folder_name)
+    os.makedirs(directory, exist_ok=True, mode=0o755)
+    filename = os.path.join(directory, short_filename)
+    lockpath = os.path.join(directory, '.' + short_filename + '.lock')
+    def render():
+        # Write to a private file first so that waiting workers never see a half-written PNG
+        tmp_filename = '{}.{}.png'.format(filename[:-4], os.getpid())
+        try:
+            make_windygram_plot(lat, lon, name, target=tmp_filename)
+            os.replace(tmp_filename, filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+    plot_flight.do(lockpath, filename, render)
+    return filepath
+
+
+def make_windygram_plot(lat, lon, name, target=None):
+    detail_data, meteo_data = forecast_cache.fetch(get_nearest_run(), lat, lon)
+    logger.debug('Fetch stats: {}'.format(forecast_client.report()))
+    logger.debug('Cache stats: {}'.format(forecast_cache.report()))
+    #
+    tic = time.time()
+    logger.debug('Start plotting')
+    w = Windygram(template=plot_template)
+    w.set_data(detail_data, meteo_data)
+    w.set_data_location()
+    # Payload comes from the nearest grid point, label the plot with the query point
+    w.set_location(lon, lat, w.altitude)
+    w.set_time()
+    w.set_name(name)
+    try:
+        w.init_plot()
+        w.plot_perci()
+        w.plot_temp()
+        w.plot_daily()
+        w.plot_wind()
+        w.plot_rh()
+        w.plot_sounding()
+        w.plot_weathercode()
+        w.plot_name()
+        w.save_plot(target)
+    finally:
+        w.close()
+    toc = time.time()
+    logger.debug('End plotting')
+    logger.debug('Plotting work elapsed: {:.1f} s'.format(toc - tic))
+
@@ -0,0 +1,157 @@
+import logging
+import math
+import threading
+import time
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from hanziconv import HanziConv
+from pypinyin import Style, lazy_pinyin
+
+from viewer.models import Station
+
+GRAM_SIZE = 3
+INDEX_TTL = 600 # in seconds, picks up changes made by other processes
+GEO_CELL = 0.5 # in degrees, bucket size of the location index
+EARTH_RADIUS = 6371. # in km
+
+logger = logging.getLogger(__name__)
+
+
+def iter_grams(text):
+    for n in range(1, GRAM_SIZE + 1):
+        for i in range(len(text) - n + 1):
+            yield text[i:i+n]
+
+def geo_cell(lat, lon):
+    return int(math.floor(lat / GEO_CELL)), int(math.floor(lon / GEO_CELL))
+
+def geo_distance(lat1, lon1, lat2, lon2):
+    """Great circle distance in km."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+class IndexSnapshot:
+    """One consistent build of the index. Never modified once built, readers
+    take a single reference and cannot mix postings of different builds."""
+
+    def __init__(self, stations=(), texts=None, grams=None, locations=(), cells=None):
+        self.stations = stations
+        self.texts = texts or {}
+        self.grams = grams or {}
+        self.locations = locations
+        self.cells = cells or {}
+
+
+class StationIndex:
+    """Process-local substring index over station codes, names, English names
+    and pinyin, plus a bucket index over station locations. Stations are kept
+    in descending `hit` order, so results come out ranked by popularity."""
+
+    FIELDS = ('code', 'name', 'en_name', 'pinyin', 'initials')
+
+    def __init__(self, ttl=INDEX_TTL):
+        self.ttl = ttl
+        self.build_time = 0
+        self.snapshot = IndexSnapshot()
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self.build_time = 0
+
+    def build(self):
+        tic = time.time()
+        stations = list(Station.objects.order_by('-hit', 'code'))
+        texts = {field: [] for field in self.FIELDS}
+        grams = {field: {} for field in self.FIELDS}
+        for station in stations:
+            texts['code'].append(station.code)
+            texts['name'].append(station.name)
+            texts['en_name'].append((station.en_name or '').lower())
+            texts['pinyin'].append(''.join(lazy_pinyin(station.name)))
+            texts['initials'].append(''.join(lazy_pinyin(station.name, style=Style.FIRST_LETTER)))
+        for field in self.FIELDS:
+            field_grams = grams[field]
+            for idx, text in enumerate(texts[field]):
+                for gram in set(iter_grams(text)):
+                    field_grams.setdefault(gram, set()).add(idx)
+        locations = [(float(station.lat), float(station.lon)) for station in stations]
+        cells = {}
+        for idx, (lat, lon) in enumerate(locations):
+            cells.setdefault(geo_cell(lat, lon), []).append(idx)
+        self.snapshot = IndexSnapshot(stations, texts, grams, locations, cells)
+        self.build_time = time.time()
+        logger.info('Station index built: {} stations in {:.0f} ms'.format(len(stations),
+            (self.build_time - tic) * 1e3))
+
+    def ensure(self):
+        if time.time() - self.build_time > self.ttl:
+            with self._lock:
+                if time.time() - self.build_time > self.ttl:
+                    self.build()
+        return self.snapshot
+
+    def _match(self, snapshot, field, content):
+        if not content:
+            return set()
+        field_grams = snapshot.grams[field]
+        if len(content) <= GRAM_SIZE:
+            return field_grams.get(content, set())
+        candidates = None
+        for i in range(len(content) - GRAM_SIZE + 1):
+            matched = field_grams.get(content[i:i+GRAM_SIZE], set())
+            candidates = matched if candidates is None else candidates & matched
+            if not candidates:
+                return set()
+        texts = snapshot.texts[field]
+        return set(idx for idx in candidates if content in texts[idx])
+
+    def search(self, fields, content, limit):
+        snapshot = self.ensure()
+        matched = set()
+        for field in fields:
+            matched |= self._match(snapshot, field, content)
+        return [snapshot.stations[idx] for idx in sorted(matched)[:limit]]
+
+    def nearest(self, lat, lon, max_distance):
+        """Return (station, distance in km) of the nearest station within
+        `max_distance` km, or (None, None). Only the 3x3 cells around the point
+        are searched, so `max_distance` must stay below the cell size (~30 km)."""
+        snapshot = self.ensure()
+        best, best_distance = None, max_distance
+        row, col = geo_cell(lat, lon)
+        for i in (row - 1, row, row + 1):
+            for j in (col - 1, col, col + 1):
+                for idx in snapshot.cells.get((i, j), ()):
+                    distance = geo_distance(lat, lon, *snapshot.locations[idx])
+                    if distance <= best_distance:
+                        best, best_distance = idx, distance
+        if best is None:
+            return None, None
+        return snapshot.stations[best], best_distance
+
+
+station_index = StationIndex()
+
+@receiver(post_save, sender=Station)
+@receiver(post_delete, sender=Station)
+def invalidate_station_index(sender, **kwargs):
+    # Hits are flushed with update() and send no signal, ranking follows on TTL expiry
+    station_index.invalidate()
+
+def nearest_station(lat, lon, max_distance):
+    return station_index.nearest(lat, lon, max_distance)
+
+def search_stations(content, limit):
+    if content.isdigit():
+        return station_index.search(('code',), content, limit)
+    elif all(ord(c) >= 128 for c in content):
+        content = HanziConv.toSimplified(content)
+        return station_index.search(('name',), content, limit)
+    elif content.isalpha():
+        content = content.lower()
+        return station_index.search(('en_name', 'pinyin', 'initials'), content, limit)
+    return None
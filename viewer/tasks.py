@@ -0,0 +1,67 @@
+import datetime
+import logging
+import os
+
+from celery import group, shared_task
+from django.conf import settings
+from django.db.models import Sum
+
+from viewer.models import HitRecord, Station
+from viewer.plotter import (get_failed_marker, get_nearest_run, get_windygram_path,
+                             get_windygram_plot)
+
+WARMUP_STATIONS = 100 # top stations by total hits
+WARMUP_RECENT_STATIONS = 50 # top stations by hits of recent days
+WARMUP_RECENT_DAYS = 7
+WARMUP_RATE = 2 # renders queued per second, keeps upstream calls polite
+WARMUP_QUEUE = 'windygram_warmup' # served apart from interactive renders
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task(ignore_result=True)
+def render_windygram(lat, lon, name):
+    # The web side polls for the PNG or its failure marker, no result backend is needed
+    try:
+        return get_windygram_plot(lat, lon, name)
+    except Exception:
+        logger.exception('Render of ({}, {}) failed'.format(lat, lon))
+        marker = get_failed_marker(get_windygram_path(lat, lon))
+        os.makedirs(os.path.dirname(marker), exist_ok=True, mode=0o755)
+        open(marker, 'w').close()
+
+def get_warmup_stations():
+    stations = list(Station.objects.order_by('-hit')[:WARMUP_STATIONS])
+    since = datetime.date.today() - datetime.timedelta(days=WARMUP_RECENT_DAYS)
+    recent_names = HitRecord.objects.filter(date__gte=since).exclude(name='0').values(
+        'name').annotate(sum=Sum('hit')).order_by('-sum').values_list('name', flat=True)
+    known_codes = set(s.code for s in stations)
+    for station in Station.objects.filter(name__in=list(recent_names[:WARMUP_RECENT_STATIONS])):
+        if station.code not in known_codes:
+            stations.append(station)
+            known_codes.add(station.code)
+    return stations
+
+@shared_task
+def warmup():
+    """Queue renders of popular stations once a new run is available. They go to
+    WARMUP_QUEUE, so they never delay interactive renders on the windygram queue."""
+    folder_name = get_nearest_run().strftime('%Y%m%d%H')
+    directory = os.path.join(settings.MEDIA_ROOT, folder_name)
+    marker = os.path.join(directory, '.warmup')
+    if os.path.exists(marker):
+        return
+    signatures = []
+    for station in get_warmup_stations():
+        lat = round(float(station.lat), 3)
+        lon = round(float(station.lon), 3)
+        if os.path.exists(os.path.join(settings.MEDIA_ROOT, get_windygram_path(lat, lon))):
+            continue
+        countdown = len(signatures) / WARMUP_RATE
+        signatures.append(render_windygram.signature((lat, lon, station.name),
+            countdown=countdown, queue=WARMUP_QUEUE))
+    group(signatures).apply_async()
+    # Marked only once queued, so that a failed run is retried by the next beat
+    os.makedirs(directory, exist_ok=True, mode=0o755)
+    open(marker, 'w').close()
+    logger.info('Warm-up queued {} plots for run {}'.format(len(signatures), folder_name))
@@ -1,3 +1,148 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase
+
+from viewer.forecast import ForecastCache, ForecastClient
+
+STUB_DELAY = 0.2 # in seconds, per response
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """Local stand-in for node.windy.com. Paths listed in `failures` answer
+    503 that many times before succeeding."""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.failures = {}
+        self.requests = []
+        self.inflight = 0
+        self.max_inflight = 0
+        self.lock = threading.Lock()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split('?')[0]
+        with server.lock:
+            server.requests.append(path)
+            server.inflight += 1
+            server.max_inflight = max(server.max_inflight, server.inflight)
+            failing = server.failures.get(path, 0)
+            if failing:
+                server.failures[path] = failing - 1
+        try:
+            time.sleep(STUB_DELAY)
+            if failing:
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            kind = 'detail' if '/v2.1/' in path else 'meteo'
+            body = json.dumps({'kind': kind, 'path': path}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.inflight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class ForecastClientTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = StubServer()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        host = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.client = ForecastClient(host=host, timeout=2)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_concurrent_fetch(self):
+        tic = time.time()
+        detail, meteo = self.client.fetch(23.125, 113.25)
+        elapsed = time.time() - tic
+        self.assertEqual(detail['kind'], 'detail')
+        self.assertEqual(meteo['kind'], 'meteo')
+        self.assertIn('/23.125/113.250', detail['path'])
+        self.assertEqual(self.server.max_inflight, 2)
+        self.assertLess(elapsed, STUB_DELAY * 2)
+
+    def test_retry(self):
+        self.server.failures['/forecast/meteogram/ecmwf/23.125/113.250'] = 1
+        detail, meteo = self.client.fetch(23.125, 113.25)
+        self.assertEqual(meteo['kind'], 'meteo')
+        self.assertEqual(self.server.requests.count('/forecast/meteogram/ecmwf/23.125/113.250'), 2)
+
+    def test_retry_exhausted(self):
+        self.server.failures['/forecast/v2.1/ecmwf/23.125/113.250'] = 5
+        with self.assertRaises(Exception):
+            self.client.fetch(23.125, 113.25)
+
+    def test_stats(self):
+        self.client.fetch(23.125, 113.25)
+        self.client.fetch(23.25, 113.25)
+        self.assertEqual(self.client.stats['detail'][0], 2)
+        self.assertEqual(self.client.stats['meteo'][0], 2)
+        self.assertGreaterEqual(self.client.stats['detail'][2], STUB_DELAY)
+        self.assertIn('detail: n=2', self.client.report())
+
+
+class ForecastCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.client = mock.Mock()
+        self.client.fetch.side_effect = lambda lat, lon: ({'lat': lat}, {'lon': lon})
+        self.run = datetime(2019, 5, 1, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_hit_renews_entry(self):
+        cache = ForecastCache(self.client, maxsize=2, root=self.root)
+        cache.fetch(self.run, 23.125, 113.25)
+        cache.fetch(self.run, 23.25, 113.25)
+        directory = cache.cache_dir(self.run)
+        for age, filename in ((200, '23.125_113.250.json'), (100, '23.250_113.250.json')):
+            stored_time = time.time() - age
+            os.utime(os.path.join(directory, filename), (stored_time, stored_time))
+        self.assertEqual(cache.fetch(self.run, 23.125, 113.25), ({'lat': 23.125}, {'lon': 113.25}))
+        cache.fetch(self.run, 23.375, 113.25)
+        self.assertEqual(sorted(os.listdir(directory)),
+            ['23.125_113.250.json', '23.375_113.250.json'])
+        self.assertEqual(self.client.fetch.call_count, 3)
+        self.assertIn('hit=1 miss=3', cache.report())
+
+    def test_expired(self):
+        cache = ForecastCache(self.client, ttl=-1, root=self.root)
+        cache.fetch(self.run, 23.125, 113.25)
+        cache.fetch(self.run, 23.125, 113.25)
+        self.assertEqual(self.client.fetch.call_count, 2)
+        self.assertEqual(cache.stats['expired'], 1)
+
+    def test_prune_runs(self):
+        cache = ForecastCache(self.client, runs=2, root=self.root)
+        for hour in (0, 12, 24):
+            cache.fetch(self.run + timedelta(hours=hour), 23.125, 113.25)
+        self.assertEqual(sorted(os.listdir(self.root)), ['2019050112', '2019050200'])
@@ -2,18 +2,19 @@ import datetime
 import json
 import logging
 import os
-import time
+import re
 
 from braces.views import AjaxResponseMixin, JSONResponseMixin
 from django.conf import settings
 from django.shortcuts import render
 from django.utils import timezone
 from django.views.generic.base import TemplateView, View
-import requests
-from hanziconv import HanziConv
 
-from viewer.models import Station, HitRecord, Notice
-from viewer.windygram.windygram import Windygram
+from viewer.hits import hit_counter
+from viewer.models import Notice
+from viewer.plotter import get_failed_marker, get_windygram_path
+from viewer.search import nearest_station, search_stations
+from viewer.tasks import render_windygram
 
 PIC_DIR = os.path.join(settings.BASE_DIR, 'img')
 
@@ -36,20 +37,11 @@ class HomepageView(TemplateView):
 
 
 SUGGESTION_NUM = 5
-TIME_00Z = datetime.time(9, 0) # BJT 17:00
-TIME_12Z = datetime.time(21, 0) # BJT 05:00
+NEAREST_STATION_DISTANCE = 5 # in km, coordinates closer than this snap to the station
+PLOT_PATH = re.compile(r'^[0-9]{10}/-?[0-9]+_[0-9]{3}--?[0-9]+_[0-9]{3}\.png$')
 
 def get_suggestion(content):
-    if content.isdigit():
-        qs = Station.objects.filter(code__contains=content).order_by('-hit')[:SUGGESTION_NUM]
-    elif all(ord(c) >= 128 for c in content):
-        content = HanziConv.toSimplified(content)
-        qs = Station.objects.filter(name__contains=content).order_by('-hit')[:SUGGESTION_NUM]
-    elif content.isalpha():
-        qs = Station.objects.filter(en_name__icontains=content).order_by('-hit')[:SUGGESTION_NUM]
-    else:
-        qs = None
-    return qs
+    return search_stations(content, SUGGESTION_NUM)
 
 
 class SearchSuggestionView(AjaxResponseMixin, JSONResponseMixin, View):
@@ -89,104 +81,72 @@ class MakingPlotView(AjaxResponseMixin, JSONResponseMixin, View):
         response = {'status': 0, 'message':''}
         query = post_data['content']
         qs = get_suggestion(query)
-        if not qs or qs.count() < 1:
+        if not qs:
             result = validate_geo_position(query)
             if not result:
                 response['status'] = 1
                 response['message'] = 'Not found'
                 return self.render_json_response(response)
             lat, lon = result
-            name = None
-            logger.info('({}, {}) selected'.format(lat, lon))
+            chosen, distance = nearest_station(lat, lon, NEAREST_STATION_DISTANCE)
+            if chosen is None:
+                logger.info('({}, {}) selected'.format(lat, lon))
+            else:
+                logger.info('({}, {}) snapped to {} {:.1f}km away'.format(lat, lon,
+                    chosen.name, distance))
         else:
             chosen = qs[0]
+        if chosen is None:
+            name = None
+            hit_counter.hit(None, '0')
+        else:
             lat = chosen.lat
             lon = chosen.lon
             name = chosen.name
             logger.info('{} ({}, {}) selected.'.format(name, lat, lon))
-            chosen.hit += 1
-            chosen.save()
-        if name is None:
-            query_name = '0'
-        else:
-            query_name = name
-        try:
-            record = HitRecord.objects.get(name=query_name, date=datetime.date.today())
-        except HitRecord.DoesNotExist:
-            record = HitRecord.objects.create(name=query_name)
-        else:
-            record.hit += 1
-            record.save()
-        lat = round(lat, 3)
-        lon = round(lon, 3)
+            hit_counter.hit(chosen.code, name)
+        lat = round(float(lat), 3)
+        lon = round(float(lon), 3)
+        filepath = get_windygram_path(lat, lon)
+        if os.path.exists(os.path.join(settings.MEDIA_ROOT, filepath)):
+            response['src'] = os.path.join(settings.MEDIA_URL, filepath)
+            return self.render_json_response(response)
+        marker = get_failed_marker(filepath)
+        if os.path.exists(marker):
+            # Asked again after a failure, give the render another try
+            os.remove(marker)
         try:
-            filepath = get_windygram_plot(lat, lon, name)
+            job = render_windygram.delay(lat, lon, name)
         except Exception as exp:
             logger.exception(exp)
             response['status'] = 2
             response['message'] = 'Internal error'
             return self.render_json_response(response)
-        response['src'] = os.path.join(settings.MEDIA_URL, filepath)
+        logger.debug('Render job {} queued.'.format(job.id))
+        response['pending'] = filepath
         return self.render_json_response(response)
 
-def get_nearest_run():
-    now = datetime.datetime.utcnow()
-    nowtime = now.time()
-    if TIME_00Z <= nowtime <= TIME_12Z:
-        return now.replace(hour=0, minute=0, second=0, microsecond=0)
-    runtime = now.replace(hour=12, minute=0, second=0, microsecond=0)
-    if nowtime < TIME_00Z:
-        runtime = runtime - datetime.timedelta(days=1)
-    return runtime
-
-def get_windygram_plot(lat, lon, name):
-    runtime = get_nearest_run()
-    folder_name = runtime.strftime('%Y%m%d%H')
-    directory = os.path.join(settings.MEDIA_ROOT, folder_name)
-    os.makedirs(directory, exist_ok=True, mode=0o755)
-    short_filename = '{:.3f}-{:.3f}'.format(lat, lon)
-    short_filename = short_filename.replace('.', '_') + '.png'
-    filename = os.path.join(directory, short_filename)
-    if not os.path.exists(filename):
-        make_windygram_plot(lat, lon, name, target=filename)
-    return '{}/{}'.format(folder_name, short_filename)
-
-
-DETAIL_ADDR = 'https://node.windy.com/forecast/v2.1/ecmwf/{:.3f}/{:.3f}?source=detail'
-METEO_ADDR = 'https://node.windy.com/forecast/meteogram/ecmwf/{:.3f}/{:.3f}'
-
-def make_windygram_plot(lat, lon, name, target=None):
-    detail_url = DETAIL_ADDR.format(lat, lon)
-    meteo_url = METEO_ADDR.format(lat, lon)
-    #
-    response = requests.get(detail_url, timeout=0.5)
-    logger.debug('Request: {}'.format(detail_url))
-    logger.debug('Elapsed: {:.0f} ms'.format(response.elapsed.microseconds / 1e3))
-    detail_data = response.json()
-    #
-    response = requests.get(meteo_url, timeout=0.5)
-    logger.debug('Request: {}'.format(meteo_url))
-    logger.debug('Elapsed: {:.0f} ms'.format(response.elapsed.microseconds / 1e3))
-    meteo_data = response.json()
-    #
-    tic = time.time()
-    logger.debug('Start plotting')
-    w = Windygram()
-    w.set_data(detail_data, meteo_data)
-    w.set_data_location()
-    w.set_time()
-    w.set_name(name)
-    w.init_plot()
-    w.plot_perci()
-    w.plot_temp()
-    w.plot_daily()
-    w.plot_wind()
-    w.plot_rh()
-    w.plot_sounding()
-    w.plot_weathercode()
-    w.plot_name()
-    w.save_plot(target)
-    toc = time.time()
-    logger.debug('End plotting')
-    logger.debug('Plotting work elapsed: {:.1f} s'.format(toc - tic))
 
+class PlotResultView(AjaxResponseMixin, JSONResponseMixin, View):
+    """Answer at once whether a queued plot has been written, so that polling
+    neither blocks a web worker nor needs a Celery result backend."""
+
+    def post_ajax(self, request, *args, **kwargs):
+        post_data = json.loads(request.body.decode())
+        response = {'status': 0, 'message':''}
+        filepath = post_data.get('pending', '')
+        if not PLOT_PATH.match(filepath):
+            response['status'] = 1
+            response['message'] = 'Not found'
+            return self.render_json_response(response)
+        if os.path.exists(get_failed_marker(filepath)):
+            response['status'] = 2
+            response['message'] = 'Internal error'
+            return self.render_json_response(response)
+        if not os.path.exists(os.path.join(settings.MEDIA_ROOT, filepath)):
+            response['status'] = 3
+            response['message'] = 'Pending'
+            response['pending'] = filepath
+            return self.render_json_response(response)
+        response['src'] = os.path.join(settings.MEDIA_URL, filepath)
+        return self.render_json_response(response)
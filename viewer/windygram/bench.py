@@ -0,0 +1,61 @@
+"""Time windygram rendering with recorded payloads, per-cell patches against
+row collections, each with and without a reused figure template.
+
+Usage: python -m viewer.windygram.bench detail.json meteo.json [rounds]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+
+from .windygram import PlotTemplate, Windygram
+
+
+def render(detail, meteo, target, template=None, collections=True):
+    w = Windygram(template=template)
+    w.use_collections = collections
+    w.set_data(detail, meteo)
+    w.set_data_location()
+    w.set_time()
+    w.set_name(None)
+    try:
+        w.init_plot()
+        w.plot_perci()
+        w.plot_temp()
+        w.plot_daily()
+        w.plot_wind()
+        w.plot_rh()
+        w.plot_sounding()
+        w.plot_weathercode()
+        w.plot_name()
+        artists = len(w.ax.get_children())
+        tic = time.time()
+        w.save_plot(target)
+        return artists, time.time() - tic
+    finally:
+        w.close()
+
+def main(detail_file, meteo_file, rounds=10):
+    detail = json.load(open(detail_file))
+    meteo = json.load(open(meteo_file))
+    target = os.path.join(tempfile.mkdtemp(), 'bench.png')
+    cases = (
+        ('per-cell', None, False),
+        ('collection', None, True),
+        ('per-cell+template', PlotTemplate(), False),
+        ('collection+template', PlotTemplate(), True),
+    )
+    for label, template, collections in cases:
+        tic = time.time()
+        saves = []
+        for i in range(rounds):
+            artists, elapsed = render(detail, meteo, target, template, collections)
+            saves.append(elapsed)
+        total = time.time() - tic
+        print('{:>19}: {} artists, savefig {:.0f} ms, render {:.0f} ms'.format(label, artists,
+            sum(saves) / rounds * 1e3, total / rounds * 1e3))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], sys.argv[2], *[int(i) for i in sys.argv[3:]])
@@ -1,10 +1,12 @@
 import json
 from datetime import datetime, timedelta
 import os
+import threading
 
 import matplotlib
 matplotlib.use('Agg')
 
+import matplotlib.colors as mclr
 import matplotlib.dates as mdt
 import matplotlib.font_manager as mfm
 import matplotlib.patches as mpatch
@@ -12,6 +14,7 @@ import matplotlib.path as mpath
 import matplotlib.pyplot as plt
 import matplotlib.transforms as mtrans
 import numpy as np
+from matplotlib.collections import PatchCollection
 from matplotlib.patheffects import Normal, Stroke
 
 from .cell import Cell, CellRow
@@ -34,23 +37,86 @@ source_font = mfm.FontProperties(fname=fontpath, size=6)
 matplotlib.rc('font', family='HelveticaNeue', size=6)
 
 
-def arrow_factory(x_center=0, y_center=0, size=1, bgcolor='w', edgecolor='w',
-                  alpha=1, angle=0, transform=None, figsize=None):
+def arrow_path(x_center=0, y_center=0, size=1, angle=0, figsize=None):
     width, height = figsize
     _arrow = ARROW.transformed(mtrans.Affine2D().rotate(angle))
     _arrow.vertices[:,0] = _arrow.vertices[:,0] * size * 0.8 * height / width  + x_center
     _arrow.vertices[:,1] = _arrow.vertices[:,1] * size * 0.8 + y_center
-    patch = mpatch.PathPatch(_arrow, clip_on=False, ec=edgecolor, fc=bgcolor,
-                             alpha=alpha, transform=transform, linewidth=0.2)
-    return patch
+    return _arrow
 
 def paste_image(filepath, x_center=0, y_center=0, size=1):
     pass
 
+class PlotTemplate:
+    """Static scaffold of a windygram (figure, axes, locators, night shading and
+    captions) kept alive in a worker process and reused across renders. Only
+    artists added after the scaffold are removed when a render is released.
+    The scaffold is rebuilt when forecast times change, i.e. once per run."""
+
+    def __init__(self, max_renders=500):
+        self.max_renders = max_renders
+        self.key = None
+        self.fig = None
+        self.ax = None
+        self.renders = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, windygram, figsize, dpi):
+        self._lock.acquire()
+        try:
+            key = (tuple(windygram.times), figsize)
+            if key != self.key or self.renders >= self.max_renders:
+                self.close()
+                windygram.init_figure(figsize)
+                self.fig = windygram.fig
+                self.ax = windygram.ax
+                self.static_axes = list(self.fig.axes)
+                self.static_artists = set(self.ax.get_children())
+                self.key = key
+            windygram.fig = self.fig
+            windygram.ax = self.ax
+            plt.sca(self.ax)
+            self.renders += 1
+        except Exception:
+            self._lock.release()
+            raise
+
+    def release(self):
+        try:
+            for ax in self.fig.axes:
+                if ax not in self.static_axes:
+                    self.fig.delaxes(ax)
+            for container in list(self.ax.containers):
+                container.remove()
+            for artist in self.ax.get_children():
+                if artist not in self.static_artists:
+                    artist.remove()
+        except Exception:
+            # Never hand out a half-cleaned figure
+            self.close()
+            raise
+        finally:
+            self._lock.release()
+
+    def close(self):
+        if self.fig is not None:
+            plt.close(self.fig)
+        self.key = None
+        self.fig = None
+        self.ax = None
+        self.renders = 0
+
+
 class Windygram:
 
-    def __init__(self):
+    # Draw cells and arrows as one collection per row, False draws one patch
+    # per cell as before, which bench.py uses for comparison
+    use_collections = True
+
+    def __init__(self, template=None):
         self.name = None
+        self.template = template
+        self.fig = None
 
     def set_location(self, lon, lat, altitude=None):
         self.lon = lon
@@ -86,6 +152,12 @@ class Windygram:
         if dpi is None:
             dpi = 250
         self.dpi = dpi
+        if self.template is None:
+            self.init_figure(figsize)
+        else:
+            self.template.acquire(self, figsize, dpi)
+
+    def init_figure(self, figsize):
         self.fig = plt.figure(figsize=figsize)
         self.ax = plt.gca()
         self.ax.xaxis.set_major_locator(mdt.HourLocator(byhour=(0,12)))
@@ -93,9 +165,10 @@ class Windygram:
         self.ax.xaxis.set_minor_locator(mdt.HourLocator(interval=3))
         self.ax.xaxis.set_minor_formatter(mdt.DateFormatter(''))
         self.init_grid()
+        self.init_caption()
 
     def init_grid(self):
-        plt.grid(True, axis='x', which='both', color='#666666', linestyle=':', linewidth=0.1)
+        self.ax.grid(True, axis='x', which='both', color='#666666', linestyle=':', linewidth=0.1)
         HALF_DAY = timedelta(hours = 12)
         # Color nights
         if self.times[0].hour > 12:
@@ -114,18 +187,46 @@ class Windygram:
             start_day += timedelta(days=1)
             yield start_day
 
+    def _plot_cellbg(self, cellrow, facecolors, alphas=None):
+        """Draw backgrounds of a whole row as one collection."""
+        if alphas is None:
+            alphas = [1] * len(cellrow.cells)
+        if not self.use_collections:
+            for cell, facecolor, alpha in zip(cellrow.cells, facecolors, alphas):
+                self.ax.add_patch(mpatch.Rectangle(xy=(cell.x, cell.y),
+                                                   width=cell.width,
+                                                   height=cell.height,
+                                                   transform=self.ax.transAxes,
+                                                   ec='k',
+                                                   fc=facecolor,
+                                                   lw=0.1,
+                                                   clip_on=False,
+                                                   alpha=alpha))
+            return
+        rects = [mpatch.Rectangle(xy=(cell.x, cell.y), width=cell.width, height=cell.height)
+                 for cell in cellrow.cells]
+        collection = PatchCollection(rects,
+                                     transform=self.ax.transAxes,
+                                     edgecolors=[mclr.to_rgba('k', a) for a in alphas],
+                                     facecolors=[mclr.to_rgba(c, a) for c, a in zip(facecolors, alphas)],
+                                     linewidths=0.1,
+                                     clip_on=False)
+        self.ax.add_collection(collection, autolim=False)
+
+    def _plot_rowname(self, cellrow):
+        self.ax.text(-0.01,
+                     cellrow.y + cellrow.height / 2,
+                     cellrow.name,
+                     size=4,
+                     #family='Source Han Sans CN',
+                     transform=self.ax.transAxes,
+                     ha='right',
+                     va='center')
+
     def _plot_cellrow(self, cellrow):
+        self._plot_cellbg(cellrow, [cell.bgcolor for cell in cellrow.cells],
+                          [cell.alpha for cell in cellrow.cells])
         for cell in cellrow.cells:
-            rect = mpatch.Rectangle(xy=(cell.x, cell.y),
-                                    width=cell.width,
-                                    height=cell.height,
-                                    transform=self.ax.transAxes,
-                                    ec='k',
-                                    fc=cell.bgcolor,
-                                    lw=0.1,
-                                    clip_on=False,
-                                    alpha=cell.alpha)
-            self.ax.add_patch(rect)
             self.ax.text(cell.x + cell.width / 2,
                          cell.y + cell.height / 2,
                          cell.text,
@@ -133,27 +234,15 @@ class Windygram:
                          transform=self.ax.transAxes,
                          ha='center',
                          va='center')
-        self.ax.text(-0.01,
-                     cellrow.y + cellrow.height / 2,
-                     cellrow.name,
-                     size=4,
-                     #family='Source Han Sans CN',
-                     transform=self.ax.transAxes,
-                     ha='right',
-                     va='center')
+        self._plot_rowname(cellrow)
 
     def _plot_vector_row(self, cellrow):
+        """Draw row backgrounds and return arrows as (path, edgecolor, bgcolor) so
+        that arrows of several rows can be drawn as one collection."""
+        self._plot_cellbg(cellrow, [cell.bgcolor for cell in cellrow.cells])
+        figsize = tuple(self.fig.get_size_inches())
+        arrows = []
         for cell in cellrow.cells:
-            rect = mpatch.Rectangle(xy=(cell.x, cell.y),
-                                    width=cell.width,
-                                    height=cell.height,
-                                    transform=self.ax.transAxes,
-                                    ec='k',
-                                    fc=cell.bgcolor,
-                                    lw=0.1,
-                                    clip_on=False,
-                                    alpha=1)
-            self.ax.add_patch(rect)
             if cell.alpha > 0.75:
                 edgecolor = 'w'
                 bgcolor = 'w'
@@ -166,40 +255,34 @@ class Windygram:
             else:
                 edgecolor = '#8888C8'
                 bgcolor = '#8888C8'
-            arrow = arrow_factory(x_center=cell.x + cell.width / 2,
-                                  y_center=cell.y + cell.height / 2,
-                                  size=cell.width,
-                                  edgecolor=edgecolor,
-                                  bgcolor=bgcolor,
-                                  angle=cell.theta,
-                                  transform=self.ax.transAxes,
-                                  figsize=tuple(self.fig.get_size_inches()))
-            self.ax.add_patch(arrow)
-        self.ax.text(-0.01,
-                     cellrow.y + cellrow.height / 2,
-                     cellrow.name,
-                     size=4,
-                     #family='Source Han Sans CN',
-                     transform=self.ax.transAxes,
-                     ha='right',
-                     va='center')
+            path = arrow_path(x_center=cell.x + cell.width / 2,
+                              y_center=cell.y + cell.height / 2,
+                              size=cell.width,
+                              angle=cell.theta,
+                              figsize=figsize)
+            arrows.append((path, edgecolor, bgcolor))
+        self._plot_rowname(cellrow)
+        return arrows
+
+    def _plot_arrows(self, arrows):
+        if not self.use_collections:
+            for path, edgecolor, bgcolor in arrows:
+                self.ax.add_patch(mpatch.PathPatch(path, clip_on=False, ec=edgecolor, fc=bgcolor,
+                                                   transform=self.ax.transAxes, linewidth=0.2))
+            return
+        patches = [mpatch.PathPatch(path) for path, _, _ in arrows]
+        collection = PatchCollection(patches,
+                                     transform=self.ax.transAxes,
+                                     edgecolors=[ec for _, ec, _ in arrows],
+                                     facecolors=[fc for _, _, fc in arrows],
+                                     linewidths=0.2,
+                                     clip_on=False)
+        self.ax.add_collection(collection, autolim=False)
 
     def _plot_coderow(self, cellrow):
+        self._plot_cellbg(cellrow, ['#E5E5E5' if cell.time.hour >= 12 else 'w'
+                                    for cell in cellrow.cells])
         for cell in cellrow.cells:
-            if cell.time.hour >= 12:
-                bgcolor = '#E5E5E5'
-            else:
-                bgcolor = 'w'
-            rect = mpatch.Rectangle(xy=(cell.x, cell.y),
-                                    width=cell.width,
-                                    height=cell.height,
-                                    transform=self.ax.transAxes,
-                                    ec='k',
-                                    fc=bgcolor,
-                                    lw=0.1,
-                                    clip_on=False,
-                                    alpha=1)
-            self.ax.add_patch(rect)
             if cell.code.char is None:
                 continue
             self.ax.text(cell.x + cell.width / 2,
@@ -211,14 +294,7 @@ class Windygram:
                          size=cell.code.size,
                          color=cell.code.color,
                          transform=self.ax.transAxes)
-        self.ax.text(-0.01,
-                     cellrow.y + cellrow.height / 2,
-                     cellrow.name,
-                     size=4,
-                     #family='Source Han Sans CN',
-                     transform=self.ax.transAxes,
-                     ha='right',
-                     va='center')
+        self._plot_rowname(cellrow)
 
     def plot_temp(self):
         TEMP = np.round(np.array(self.d_detail['data']['temp']) - 273.1, 1)
@@ -401,8 +477,10 @@ class Windygram:
                 cellrow.add_cell(c)
             cellrows.append(cellrow)
             ybase += self.unit * 2
+        arrows = []
         for cellrow in cellrows:
-            self._plot_vector_row(cellrow)
+            arrows.extend(self._plot_vector_row(cellrow))
+        self._plot_arrows(arrows)
 
     def plot_weathercode(self):
         CODES = self.d_detail['data']['weathercode']
@@ -419,17 +497,21 @@ class Windygram:
             coderow.add_cell(c)
         self._plot_coderow(coderow)
 
-    def plot_name(self):
+    def init_caption(self):
         text_kwargs = {'va':'bottom', 'color':'#666666', 'size':6, 'transform':self.ax.transAxes}
         ybase = 1.37
         self.ax.text(self.unit, ybase+self.unit*2, 'WINDYGRAM', ha='left', **text_kwargs)
         self.ax.text(self.unit, ybase, 'ECMWF HRES 13km', ha='left', **text_kwargs)
+        self.ax.text(1-self.unit, ybase+self.unit*2, '@NASDAQ', ha='right', **text_kwargs)
+
+    def plot_name(self):
+        text_kwargs = {'va':'bottom', 'color':'#666666', 'size':6, 'transform':self.ax.transAxes}
+        ybase = 1.37
         lat_char = 'N' if self.lat >= 0 else 'S'
         lon_char = 'E' if self.lon >= 0 else 'W'
         position_str = '{}{} {}{}'.format(abs(self.lat), lat_char, abs(self.lon), lon_char)
         self.ax.text(0.5, ybase, position_str, ha='center', **text_kwargs)
         self.ax.text(1-self.unit, ybase, self.basetime.strftime('%Y/%m/%d %HZ'), ha='right', **text_kwargs)
-        self.ax.text(1-self.unit, ybase+self.unit*2, '@NASDAQ', ha='right', **text_kwargs)
         if self.name:
             text_kwargs.update(color='k', fontproperties=source_font)
             self.ax.text(0.5, ybase+self.unit*2, self.name, ha='center', **text_kwargs)
@@ -438,7 +520,17 @@ class Windygram:
         THREEHOUR = timedelta(hours=3)
         self.ax.xaxis.set_major_locator(mdt.HourLocator(byhour=(0, 12)))
         self.ax.xaxis.set_major_formatter(mdt.DateFormatter('%d/%HZ'))
-        plt.xlim([self.times[0] - THREEHOUR, self.times[-1] + THREEHOUR])
+        self.ax.set_xlim([self.times[0] - THREEHOUR, self.times[-1] + THREEHOUR])
         self.filename = target
         self.fig.savefig(target, dpi=self.dpi, bbox_inches='tight', edgecolor='none',
                          pad_inches=0.05)
+
+    def close(self):
+        """Hand the figure back to the template, or close it if there is none."""
+        if self.fig is None:
+            return
+        if self.template is None:
+            plt.close(self.fig)
+        else:
+            self.template.release()
+        self.fig = None
@@ -32,10 +32,25 @@ app.conf.update(
         'sate-data-cleaner': {
             'task': 'sate.tasks.cleaner',
             'schedule': crontab(minute=15)
+        },
+        # Does nothing until get_nearest_run switches to a new run folder
+        'windygram-warmup': {
+            'task': 'viewer.tasks.warmup',
+            'schedule': crontab(minute=[5, 35])
         }
     }
 )
-app.conf.worker_concurrency = 1
+app.conf.task_routes = {
+    # Interactive renders get their own worker, so that sate tasks and warm-up
+    # bursts never queue in front of a click:
+    #   celery -A windygram worker -Q windygram -c 4
+    #   celery -A windygram worker -Q windygram_warmup -c 1
+    # warmup() sends its renders to windygram_warmup explicitly.
+    'viewer.tasks.render_windygram': {'queue': 'windygram'}
+}
+# Bands of a satellite slot are imaged in parallel, one per process
+app.conf.worker_concurrency = os.cpu_count() or 1
+app.conf.worker_prefetch_multiplier = 1
 app.conf.worker_max_tasks_per_child = 24
 
 # Load task modules from all registered Django app configs.
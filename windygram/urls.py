@@ -27,4 +27,5 @@ urlpatterns = [
     path('', RedirectView.as_view(pattern_name='home', permanent=True)),
     path('ajax/search', SearchSuggestionView.as_view(), name='search'),
     path('ajax/plot', MakingPlotView.as_view(), name='plot'),
+    path('ajax/result', PlotResultView.as_view(), name='result'),
 ]